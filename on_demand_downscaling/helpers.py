@@ -18,6 +18,11 @@ from functools import partial
 from urllib.parse import urlparse
 from IPython.utils.capture import capture_output
 
+# Share the Panel app's coordinate-axis cache (and its binary-search lookups)
+# and its WPS status poller; `poetry install` installs the panel_app package
+from panel_app.panel_UI.coordinate_axis import get_axis, get_index_range
+from panel_app.panel_UI.wps_status import wait_for_execution
+
 # Instantiate the clients to the two birds. This instantiation also takes advantage of asynchronous execution by setting `progress` to True.
 host = os.getenv("BIRDHOUSE_HOST_URL", "https://marble-dev01.pcic.uvic.ca")
 chickadee_url = f"{host}/twitcher/ows/proxy/chickadee/wps"
@@ -41,8 +46,8 @@ def in_bc(point):
     the BC PRISM grid."""
     bc = f"{thredds_base}/storage/data/climate/PRISM/dataportal/pr_monClim_PRISM_historical_run1_198101-201012.nc"
     bc_data = Dataset(bc)
-    bc_lat = bc_data.variables["lat"][:]
-    bc_lon = bc_data.variables["lon"][:]
+    bc_lat = get_axis(bc, "lat", bc_data)
+    bc_lon = get_axis(bc, "lon", bc_data)
     # Check if center point is within lat/lon grid
     if (
         (point[0] < bc_lat[0])
@@ -53,8 +58,8 @@ def in_bc(point):
         return False
     # Check if center point is closest to a masked data value
     else:
-        lat_index = np.argmin(np.abs(bc_lat - point[0]))
-        lon_index = np.argmin(np.abs(bc_lon - point[1]))
+        lat_index = bc_lat.nearest(point[0])
+        lon_index = bc_lon.nearest(point[1])
         pr = bc_data.variables["pr"][0, lat_index, lon_index]
         if pr.mask:
             return False
@@ -196,14 +201,6 @@ def get_time_range(dataset, downscaled_period):
     return f"[{start_bound}:{end_bound}]"
 
 
-def get_index_range(arr, min_val, max_val):
-    """Compute the indices in an array that correspond to the array's values
-    closest to desired min/max values."""
-    min_index = np.argmin(np.abs(arr - min_val))
-    max_index = np.argmin(np.abs(arr - max_val))
-    return (min_index, max_index)
-
-
 def concat_baseline_future(gcm_dataset, gcm_subset_file, gcm_time_range):
     """Concatenate the subset for the 1981-2010 calibration period with the
     selected future period. Return the concatenation as a temporary file.
@@ -302,10 +299,10 @@ def handle_run_downscaling(arg):
     obs_dataset = Dataset(obs_file)
 
     # Obtain the datasets' latitudes and longitudes to determine the subdomains
-    gcm_lats = gcm_dataset.variables["lat"][:]
-    gcm_lons = gcm_dataset.variables["lon"][:]
-    obs_lats = obs_dataset.variables["lat"][:]
-    obs_lons = obs_dataset.variables["lon"][:]
+    gcm_lats = get_axis(gcm_file, "lat", gcm_dataset)
+    gcm_lons = get_axis(gcm_file, "lon", gcm_dataset)
+    obs_lats = get_axis(obs_file, "lat", obs_dataset)
+    obs_lons = get_axis(obs_file, "lon", obs_dataset)
     gcm_lat_indices = get_index_range(gcm_lats, m.lat_min_gcm, m.lat_max_gcm)
     gcm_lon_indices = get_index_range(gcm_lons, m.lon_min_gcm, m.lon_max_gcm)
     obs_lat_indices = get_index_range(obs_lats, m.lat_min_obs, m.lat_max_obs)
@@ -341,8 +338,7 @@ def handle_run_downscaling(arg):
         tasmean = finch.tg(
             tasmax=tasmax_file, tasmin=tasmin_file, output_name="tasmean"
         )
-        while tasmean.isNotComplete():
-            sleep(3)
+        wait_for_execution(tasmean)
         gcm_file = (
             thredds_base
             + "/birdhouse_wps_outputs"
@@ -0,0 +1,164 @@
+"""
+Async worker mode: one process running several ODDS jobs at once.
+
+An ODDS job spends nearly all of its time waiting on chickadee and finch, so
+with WORKER_MODE=async a worker process runs up to ASYNC_WORKER_JOBS jobs side
+by side instead of one. Each job runs in a thread of its own (a job slot),
+not as a coroutine: the job code, birdy and owslib all block. While a job
+waits on a WPS execution its thread is parked on the process's shared
+wps_status poller, which does all the status polling from a single thread.
+
+The asyncio event loop only supervises the slots: it hands each slot's dequeue
+and job to a thread pool, heartbeats the running jobs, keeps the RQ scheduler
+going and, on SIGTERM/SIGINT, stops dequeuing and lets the running jobs finish
+(a second signal exits at once; the jobs are then restarted from their
+checkpoints as abandoned). Slots dequeue in the same fair-share, weighted
+order as the sync worker, and wps_admission caps the executions each process
+holds per service (WPS_PROCESS_LIMITS).
+"""
+
+import asyncio
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from rq.logutils import setup_loghandlers
+from rq.scheduler import RQScheduler
+from rq.timeouts import TimerDeathPenalty
+from rq.utils import now
+from rq.worker import SimpleWorker
+from rq.worker.base import BaseWorker
+from .config import ASYNC_WORKER_JOBS, ASYNC_DEQUEUE_TIMEOUT
+from .fair_share import FairShareWorker
+
+
+class JobSlotWorker(SimpleWorker, FairShareWorker):
+    """A job slot of the async worker: runs one job at a time in its thread."""
+
+    # Signal-based job timeouts only work in the main thread
+    death_penalty_class = TimerDeathPenalty
+
+    def get_heartbeat_ttl(self, job):
+        # The supervisor heartbeats running jobs, so a dead process is noticed
+        # within the monitoring interval rather than after the job timeout
+        return BaseWorker.get_heartbeat_ttl(self, job)
+
+    def maintain_heartbeats(self, job):
+        # Called by the supervisor while the slot's thread may finish the job
+        # and clear self.execution, so the execution is read once
+        execution = self.execution
+        if execution is None:
+            return
+        with self.connection.pipeline() as pipeline:
+            self.heartbeat(self.job_monitoring_interval + 60, pipeline=pipeline)
+            ttl = int(self.get_heartbeat_ttl(job))
+            execution.heartbeat(job.started_job_registry, ttl, pipeline=pipeline)
+            job.heartbeat(now(), ttl, pipeline=pipeline, xx=True)
+            if pipeline.execute()[-1] == 1:
+                # The job was deleted (result_ttl=0) before this heartbeat
+                # recreated its key
+                self.connection.delete(job.key)
+
+
+class AsyncJobSupervisor:
+    """Runs `jobs` JobSlotWorkers on `queues` from one asyncio event loop."""
+
+    def __init__(self, queues, connection, jobs=ASYNC_WORKER_JOBS):
+        self.queues = queues
+        self.connection = connection
+        prefix = f"{socket.gethostname()}.{os.getpid()}"
+        self.slots = [
+            JobSlotWorker(queues, connection=connection, name=f"{prefix}.{i}")
+            for i in range(jobs)
+        ]
+        self.scheduler = None
+        self._stopping = None
+        self._executor = None
+
+    def request_stop(self):
+        if self._stopping.is_set():
+            print("❗ Second stop request: exiting without waiting for running jobs")
+            os._exit(1)
+        print("Stop requested: finishing running jobs, press Ctrl+C again to exit now")
+        self._stopping.set()
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    async def _run_slot(self, worker):
+        await self._in_thread(worker.register_birth)
+        try:
+            while not self._stopping.is_set():
+                result = await self._in_thread(
+                    worker.dequeue_job_and_maintain_ttl,
+                    ASYNC_DEQUEUE_TIMEOUT,
+                    ASYNC_DEQUEUE_TIMEOUT,
+                )
+                if result is None:
+                    continue
+                job, queue = result
+                # Failures are handled (and recorded) by RQ inside execute_job
+                await self._in_thread(worker.execute_job, job, queue)
+        finally:
+            await self._in_thread(worker.register_death)
+
+    def _maintain(self):
+        # Running jobs only stay alive through these heartbeats: one slot's
+        # error must not stop the others'
+        for worker in self.slots:
+            try:
+                job = worker.get_current_job()
+                if job is not None:
+                    worker.maintain_heartbeats(job)
+            except Exception as e:
+                print(f"❗ Could not heartbeat {worker.name}: {e}")
+        if self.scheduler is not None:
+            try:
+                self.scheduler.acquire_locks(auto_start=True)
+            except Exception as e:
+                print(f"❗ Could not refresh the scheduler locks: {e}")
+
+    async def _maintain_forever(self):
+        interval = self.slots[0].job_monitoring_interval
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._in_thread(self._maintain)
+            except Exception as e:
+                print(f"❗ Async worker maintenance failed: {e}")
+
+    async def run(self, with_scheduler=True):
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.request_stop)
+
+        # One thread per slot plus one for heartbeats and maintenance
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.slots) + 1, thread_name_prefix="odds-job-slot"
+        )
+        if with_scheduler:
+            self.scheduler = RQScheduler(self.queues, connection=self.connection)
+            self.scheduler.acquire_locks(auto_start=True)
+
+        print(f"Async worker running {len(self.slots)} job slots")
+        maintenance = asyncio.create_task(self._maintain_forever())
+        try:
+            await asyncio.gather(*(self._run_slot(worker) for worker in self.slots))
+        finally:
+            maintenance.cancel()
+            if self.scheduler is not None:
+                self.scheduler.release_locks()
+                process = self.scheduler._process
+                if process is not None and process.pid:
+                    process.terminate()
+                    process.join()
+            self._executor.shutdown(wait=True)
+        print("Async worker stopped")
+
+
+def run_async_worker(queues, connection, jobs=ASYNC_WORKER_JOBS, with_scheduler=True):
+    setup_loghandlers("INFO")
+    asyncio.run(AsyncJobSupervisor(queues, connection, jobs).run(with_scheduler))
@@ -0,0 +1,283 @@
+"""
+Persistent index of the CMIP6 BCCAQv2 / MBCn THREDDS catalogs.
+
+The catalogs are crawled once and stored at CATALOG_INDEX_PATH as
+
+    {"models": [...], "files": {model: {technique: {var: {scenario: {run: url}}}}}}
+
+so GCM files can be resolved with dictionary lookups instead of fetching and
+scanning catalog.xml on every request. catalog_entry_fingerprint identifies
+the listing of the catalog directory holding a file, which changes only when
+that directory does.
+
+The index is only built out of band, never in a lookup: a background thread
+started by the Panel app (start_catalog_refresher) rebuilds it when it is
+missing or older than CATALOG_INDEX_REFRESH_SECONDS, one process at a time
+(Redis lock). Every process, workers included, picks up the new file on its
+next lookup. Until the first index exists, lookups read the one catalog they
+need from THREDDS.
+
+Rebuild the index by hand with:
+
+    python -m panel_app.panel_UI.catalog_index
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+from time import sleep, time
+import redis
+import requests
+from .config import (
+    CATALOG_INDEX_PATH,
+    CATALOG_INDEX_REFRESH_SECONDS,
+    bccaq2_catalog_url,
+    cmip6_catalog_url,
+    cmip6_url,
+    REDIS_URL,
+)
+
+conn = redis.from_url(REDIS_URL)
+
+THREDDS_NS = {"thredds": "http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"}
+XLINK_TITLE = "{http://www.w3.org/1999/xlink}title"
+
+# Entries of the BCCAQv2 catalog that are not models
+EXCLUDED_CATALOG_REFS = [
+    "AgroClimate",
+    "CMIP6_BCCAQv2",
+    "CWEC2020_Factors",
+    "Degree_Climatologies",
+    "Ensemble_Averages",
+    "nobackup",
+    "--",
+    "",
+]
+GCM_VARIABLES = ("pr", "tasmax", "tasmin")
+SCENARIO_RE = re.compile(r"ssp\d{3}")
+RUN_RE = re.compile(r"r\d+i\d+p\d+f\d+")
+
+# Held by the process rebuilding the index (expires if it dies)
+REFRESH_LOCK_KEY = "odds:catalog_index:refresh"
+REFRESH_LOCK_SECONDS = 60 * 60
+
+_index = None
+_index_mtime = None
+# {file URL: fingerprint of its model/technique listing} of the loaded index
+_entry_fingerprints = {}
+_index_lock = threading.Lock()
+_refresher = None
+
+
+def technique_dirs(technique, model):
+    """THREDDS (technique_dir, model_dir) for a technique/model pair."""
+    if technique == "BCCAQv2":
+        return "BCCAQ2", model
+    return "MBCn", f"{model}_10"
+
+
+def _get_catalog(url):
+    r = requests.get(url, timeout=60)
+    r.raise_for_status()
+    return ET.fromstring(r.content)
+
+
+def _index_model(technique, model):
+    """Map var -> scenario -> run -> URL for one model directory."""
+    tech_dir, model_dir = technique_dirs(technique, model)
+    root = _get_catalog(cmip6_catalog_url(tech_dir, technique, model_dir))
+    files = {}
+    for dataset in root.findall(".//thredds:dataset", THREDDS_NS):
+        name = dataset.get("name")
+        if not name or not name.endswith(".nc"):
+            continue
+        var = name.split("_", 1)[0]
+        scenario = SCENARIO_RE.search(name)
+        run = RUN_RE.search(name)
+        if var not in GCM_VARIABLES or not scenario:
+            continue
+        runs = files.setdefault(var, {}).setdefault(scenario.group(), {})
+        runs.setdefault(
+            run.group() if run else "", cmip6_url(tech_dir, technique, model_dir, name)
+        )
+    return files
+
+
+def _catalog_models():
+    root = _get_catalog(bccaq2_catalog_url())
+    return sorted(
+        name
+        for name in (
+            ref.get(XLINK_TITLE)
+            for ref in root.findall(".//thredds:catalogRef", THREDDS_NS)
+        )
+        if name and name not in EXCLUDED_CATALOG_REFS
+    )
+
+
+def _fingerprint(files):
+    return hashlib.sha256(json.dumps(files, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def build_catalog_index():
+    """Crawl the THREDDS catalogs and write the index to CATALOG_INDEX_PATH."""
+    print("Building THREDDS catalog index")
+    models = _catalog_models()
+    if not models:
+        raise ValueError(f"No models found in THREDDS catalog: {bccaq2_catalog_url()}")
+
+    files = {}
+    for model in models:
+        for technique in ("BCCAQv2", "MBCn"):
+            try:
+                files.setdefault(model, {})[technique] = _index_model(technique, model)
+            except requests.HTTPError as e:
+                # Not every model has been downscaled with both techniques
+                print(f"Skipping {technique}/{model} in catalog index: {e}")
+
+    index = {
+        "built_at": time(),
+        # Changes only when the set of files changes
+        "fingerprint": _fingerprint(files),
+        "models": models,
+        "files": files,
+    }
+    os.makedirs(os.path.dirname(CATALOG_INDEX_PATH), exist_ok=True)
+    tmp = f"{CATALOG_INDEX_PATH}.tmp.{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, CATALOG_INDEX_PATH)
+    return index
+
+
+def _index_age():
+    try:
+        return time() - os.path.getmtime(CATALOG_INDEX_PATH)
+    except OSError:
+        return float("inf")
+
+
+def refresh_catalog_index(max_age=CATALOG_INDEX_REFRESH_SECONDS):
+    """
+    Rebuild the index if it is older than `max_age`, unless another process is
+    already rebuilding it. Returns whether the index is now fresh.
+    """
+    lock = conn.lock(REFRESH_LOCK_KEY, timeout=REFRESH_LOCK_SECONDS)
+    try:
+        if not lock.acquire(blocking=False):
+            return False
+    except redis.RedisError as e:
+        print(f"❗ Catalog index lock unavailable ({e}); refreshing anyway")
+        lock = None
+    try:
+        # Another process may have finished a rebuild just before
+        if _index_age() >= max_age:
+            build_catalog_index()
+        return True
+    finally:
+        if lock is not None:
+            try:
+                lock.release()
+            except redis.RedisError:
+                pass
+
+
+def _refresh_loop():
+    while True:
+        age = _index_age()
+        if age >= CATALOG_INDEX_REFRESH_SECONDS:
+            try:
+                if refresh_catalog_index():
+                    age = 0
+                else:
+                    # Another process is rebuilding: look for its file shortly
+                    age = CATALOG_INDEX_REFRESH_SECONDS
+            except Exception as e:
+                # Keep serving the previous index; try again later
+                print(f"❗ Catalog index refresh failed: {e}")
+                age = CATALOG_INDEX_REFRESH_SECONDS - 300
+        sleep(max(CATALOG_INDEX_REFRESH_SECONDS - min(age, CATALOG_INDEX_REFRESH_SECONDS), 60))
+
+
+def start_catalog_refresher():
+    global _refresher
+    if _refresher is None or not _refresher.is_alive():
+        _refresher = threading.Thread(
+            target=_refresh_loop, name="catalog-index-refresh", daemon=True
+        )
+        _refresher.start()
+
+
+def get_catalog_index():
+    """
+    Return the catalog index, (re)loading it from disk when the file changes,
+    or None while it has not been built yet.
+    """
+    global _index, _index_mtime
+    with _index_lock:
+        try:
+            mtime = os.path.getmtime(CATALOG_INDEX_PATH)
+        except OSError:
+            return None
+        if _index is None or mtime != _index_mtime:
+            with open(CATALOG_INDEX_PATH) as f:
+                _index = json.load(f)
+            _index_mtime = mtime
+            _entry_fingerprints.clear()
+            for techniques in _index["files"].values():
+                for files in techniques.values():
+                    fingerprint = _fingerprint(files)
+                    for scenarios in files.values():
+                        for runs in scenarios.values():
+                            for url in runs.values():
+                                _entry_fingerprints[url] = fingerprint
+    return _index
+
+
+def catalog_entry_fingerprint(url):
+    """
+    Fingerprint of the listing of the catalog directory holding `url`, or None
+    if the file is not in the index (or there is no index yet).
+    """
+    if get_catalog_index() is None:
+        return None
+    with _index_lock:
+        return _entry_fingerprints.get(url)
+
+
+def get_catalog_models():
+    index = get_catalog_index()
+    if index is None:
+        return _catalog_models()
+    return list(index["models"])
+
+
+def lookup_gcm_url(model, technique, var, scenario, run=None):
+    """
+    URL of the CMIP6 file for the given parameters. When `run` is None the
+    first available run is used (every model but CanESM5 has only one).
+    """
+    index = get_catalog_index()
+    if index is None:
+        try:
+            files = _index_model(technique, model)
+        except requests.HTTPError:
+            files = {}
+    else:
+        files = index["files"].get(model, {}).get(technique, {})
+    runs = files.get(var, {}).get(scenario, {})
+    if run is None and runs:
+        return runs[sorted(runs)[0]]
+    if run in runs:
+        return runs[run]
+    raise LookupError(
+        f"No file found for var={var}, scenario={scenario}, model={model}, "
+        f"technique={technique}, run={run}"
+    )
+
+
+if __name__ == "__main__":
+    build_catalog_index()
@@ -0,0 +1,210 @@
+"""
+Coalescing of identical WPS requests across jobs and workers.
+
+The first requester of a canonical key (see result_cache.canonical_key) takes
+a Redis lock, submits the execution and publishes its status URL. Anyone else
+asking for the same key while it runs attaches to that execution instead of
+submitting a duplicate. The owner renews its lease while it waits; if it dies
+the lease expires, attached waiters keep polling the status URL directly, and
+a waiter that arrives before anything was submitted takes over as owner.
+
+Submitted executions are also recorded durably (status URL and how to collect
+the result) until their result is cached. A new owner of the key attaches to
+a recorded execution instead of resubmitting it, and a starting worker resumes
+the recorded executions nobody owns any more (resume_orphaned_executions).
+"""
+
+import json
+import threading
+from time import sleep, time
+import redis
+from .config import (
+    INFLIGHT_LEASE_SECONDS,
+    INFLIGHT_CHECK_SECONDS,
+    OUTPUT_RETENTION_SECONDS,
+)
+from .result_cache import conn, get_cached_result, store_result
+from .wps_status import execution_from_status_url, wait_for_execution
+
+EXECUTION_PREFIX = "odds:execution:"
+
+
+def _lock_name(key):
+    return f"odds:inflight:{key}"
+
+
+def _status_name(key):
+    return f"odds:inflight:{key}:status"
+
+
+def _execution_name(key):
+    return f"{EXECUTION_PREFIX}{key}"
+
+
+def _record_execution(key, execution, collect_spec):
+    record = {
+        "status_url": execution.statusLocation,
+        "collect_spec": collect_spec,
+        "submitted_at": time(),
+    }
+    try:
+        conn.set(_execution_name(key), json.dumps(record), ex=OUTPUT_RETENTION_SECONDS)
+    except redis.RedisError as e:
+        print(f"❗ Could not record execution for {key}: {e}")
+
+
+def _forget_execution(key):
+    try:
+        conn.delete(_execution_name(key))
+    except redis.RedisError:
+        pass
+
+
+def _attach_recorded(key):
+    """The recorded execution of `key`, if its status can still be read."""
+    try:
+        raw = conn.get(_execution_name(key))
+    except redis.RedisError:
+        return None
+    if raw is None:
+        return None
+    status_url = json.loads(raw)["status_url"]
+    try:
+        execution = execution_from_status_url(status_url)
+    except Exception as e:
+        print(f"❗ Recorded execution {status_url} is gone, resubmitting: {e}")
+        _forget_execution(key)
+        return None
+    print(f"Resuming recorded execution: {status_url}")
+    return execution
+
+
+def _heartbeat(lock, key, stop):
+    while not stop.wait(INFLIGHT_LEASE_SECONDS / 3):
+        try:
+            lock.reacquire()
+            conn.expire(_status_name(key), INFLIGHT_LEASE_SECONDS)
+        except (redis.RedisError, redis.exceptions.LockError) as e:
+            print(f"❗ Could not renew in-flight lease for {key}: {e}")
+
+
+def _run_as_owner(lock, key, submit, collect, collect_spec=None):
+    stop = threading.Event()
+    threading.Thread(
+        target=_heartbeat, args=(lock, key, stop), name="inflight-lease", daemon=True
+    ).start()
+    try:
+        execution = _attach_recorded(key)
+        if execution is None:
+            execution = submit()
+            _record_execution(key, execution, collect_spec)
+        try:
+            conn.set(
+                _status_name(key), execution.statusLocation, ex=INFLIGHT_LEASE_SECONDS
+            )
+        except redis.RedisError as e:
+            print(f"❗ Could not publish in-flight execution for {key}: {e}")
+        try:
+            wait_for_execution(execution)
+            result = collect(execution)
+        except Exception:
+            # A failed execution must be resubmitted by the next attempt
+            _forget_execution(key)
+            raise
+        store_result(key, result)
+        _forget_execution(key)
+        return result
+    finally:
+        stop.set()
+        try:
+            conn.delete(_status_name(key))
+            lock.release()
+        except (redis.RedisError, redis.exceptions.LockError):
+            pass
+
+
+def run_coalesced(key, submit, collect, collect_spec=None):
+    """
+    Return `collect(execution)` for the execution identified by `key`.
+
+    `submit()` starts the WPS execution (only called by the owner) and
+    `collect(execution)` turns the finished execution into the result that
+    is cached and returned. `collect_spec` ({"kind", "args"}) is recorded with
+    the execution so that it can be collected after a restart.
+    """
+    while True:
+        cached = get_cached_result(key)
+        if cached is not None:
+            return cached
+
+        try:
+            lock = conn.lock(
+                _lock_name(key), timeout=INFLIGHT_LEASE_SECONDS, thread_local=False
+            )
+            if lock.acquire(blocking=False):
+                return _run_as_owner(lock, key, submit, collect, collect_spec)
+            status_url = conn.get(_status_name(key))
+        except redis.RedisError as e:
+            print(f"❗ Request coalescing unavailable, running directly: {e}")
+            execution = submit()
+            wait_for_execution(execution)
+            return collect(execution)
+
+        if status_url:
+            status_url = status_url.decode()
+            print(f"Attaching to in-flight execution: {status_url}")
+            execution = execution_from_status_url(status_url)
+            wait_for_execution(execution)
+            result = collect(execution)
+            store_result(key, result)
+            return result
+
+        # Owner hasn't submitted yet (e.g. still computing tasmean)
+        sleep(INFLIGHT_CHECK_SECONDS)
+
+
+def _resume(lock, key, collect_spec, collectors):
+    def submit():
+        raise RuntimeError("orphaned executions are only resumed, never resubmitted")
+
+    collector = collectors[collect_spec["kind"]]
+    try:
+        _run_as_owner(
+            lock,
+            key,
+            submit,
+            lambda execution: collector(execution, **collect_spec["args"]),
+            collect_spec,
+        )
+        print(f"Resumed orphaned execution for {key}")
+    except Exception as e:
+        print(f"❗ Could not resume orphaned execution for {key}: {e}")
+
+
+def resume_orphaned_executions(collectors):
+    """
+    Resume polling, in background threads, every recorded execution whose owner
+    is gone, and cache its result. `collectors` maps a collect_spec "kind" to
+    `collector(execution, **args)`. Returns the number of executions resumed.
+    """
+    resumed = 0
+    for name in conn.scan_iter(match=f"{EXECUTION_PREFIX}*"):
+        key = name.decode()[len(EXECUTION_PREFIX):]
+        raw = conn.get(name)
+        if raw is None:
+            continue
+        collect_spec = json.loads(raw).get("collect_spec")
+        if not collect_spec or collect_spec["kind"] not in collectors:
+            continue
+        lock = conn.lock(_lock_name(key), timeout=INFLIGHT_LEASE_SECONDS, thread_local=False)
+        if not lock.acquire(blocking=False):
+            # Still owned by a live worker
+            continue
+        threading.Thread(
+            target=_resume,
+            args=(lock, key, collect_spec, collectors),
+            name="resume-execution",
+            daemon=True,
+        ).start()
+        resumed += 1
+    return resumed
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from birdy import WPSClient
 from datetime import date
 from dotenv import load_dotenv
@@ -20,12 +21,182 @@ THREDDS_CATALOG = f"{BIRDHOUSE_FQDN}/twitcher/ows/proxy/thredds/catalog/datasets
 
 chickadee = WPSClient(CHICKADEE_URL, progress=True)
 finch = WPSClient(FINCH_URL, progress=True)
+# progress=True submits executions in asynchronous mode. Don't let birdy block on
+# its console monitor (which only works on the main thread); the worker waits
+# through the shared poller in wps_status.py instead.
+chickadee._interactive = False
+finch._interactive = False
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# --- Worker ---
+# Maximum number of variables of one job downscaled at the same time
+DOWNSCALE_CONCURRENCY = int(os.getenv("DOWNSCALE_CONCURRENCY", "4"))
+# Maximum number of indices of one job submitted to finch at the same time
+INDEX_CONCURRENCY = int(os.getenv("INDEX_CONCURRENCY", "4"))
+# "finch" computes tasmean with finch.tg; "local" computes it in the worker
+# (local_tasmean.py) and serves it to chickadee from INTERMEDIATE_DIR
+TASMEAN_ENGINE = os.getenv("TASMEAN_ENGINE", "finch")
+INTERMEDIATE_DIR = os.getenv("INTERMEDIATE_DIR")
+INTERMEDIATE_BASE_URL = os.getenv("INTERMEDIATE_BASE_URL")
+# Local tasmean files (INTERMEDIATE_DIR/tasmean) beyond this size are evicted,
+# least recently used first
+TASMEAN_CACHE_MB = int(os.getenv("TASMEAN_CACHE_MB", "8192"))
+# Intermediates in use by a job are pinned against eviction; the pins are leased
+# for this long and renewed every third of it while held
+INTERMEDIATE_PIN_LEASE_SECONDS = 60 * 5
+# Days of daily data per chunk when streaming files in the worker
+LOCAL_CHUNK_DAYS = int(os.getenv("LOCAL_CHUNK_DAYS", "365"))
+# Memory budget (MB) of one chunk of daily data when the worker processes
+# whole time series (all days of a block of grid rows), and of one read of them
+LOCAL_CHUNK_MB = int(os.getenv("LOCAL_CHUNK_MB", "256"))
+# Percentile references (days_over_precip_thresh) are computed in blocks of grid
+# cells holding the whole period, one block of at most this size at a time
+PERCENTILE_MEMORY_MB = int(os.getenv("PERCENTILE_MEMORY_MB", "1024"))
+# "finch" computes each index with a finch process; "local" computes the indices
+# of a job in the worker, one pass per set of inputs (local_indices.py)
+INDEX_ENGINE = os.getenv("INDEX_ENGINE", "finch")
+# Local index outputs go to this directory of the WPS outputs area, served at
+# LOCAL_INDEX_OUTPUT_URL (under .../wpsoutputs/, like finch's outputs)
+LOCAL_INDEX_OUTPUT_DIR = os.getenv("LOCAL_INDEX_OUTPUT_DIR")
+LOCAL_INDEX_OUTPUT_URL = os.getenv(
+    "LOCAL_INDEX_OUTPUT_URL", f"{BIRDHOUSE_PUB_URL}/wpsoutputs/odds"
+)
+# In-flight executions are shared between identical requests; the owner's lease
+# must be renewed within this time or another worker takes over
+INFLIGHT_LEASE_SECONDS = 120
+# How often a waiter checks whether the owner has submitted yet
+INFLIGHT_CHECK_SECONDS = 5
+# Outputs are purged from the ODDS_outputs area after 7 days; cached results
+# stop being handed out a little before that so users still get a download window
+OUTPUT_RETENTION_SECONDS = 60 * 60 * 24 * 7
+RESULT_CACHE_MARGIN_SECONDS = int(
+    os.getenv("RESULT_CACHE_MARGIN_SECONDS", str(60 * 60 * 24))
+)
+
+# --- WPS admission ---
+# Executions of ours that may run on chickadee at once, across all workers
+# (keep at or below its PyWPS maxprocesses)
+CHICKADEE_CAPACITY = int(os.getenv("CHICKADEE_CAPACITY", "4"))
+# Same for finch (indices and tasmean)
+FINCH_CAPACITY = int(os.getenv("FINCH_CAPACITY", "6"))
+# Slots are leased for this long and renewed every third of it while held, so
+# the slot of a dead worker is freed within the lease
+WPS_SLOT_LEASE_SECONDS = 60 * 5
+# Waiting longer than this for a slot requeues the job
+WPS_SLOT_WAIT_SECONDS = 60 * 30
+# Jobs refused with ServerBusy are requeued after a jittered exponential backoff
+BUSY_BACKOFF_BASE_SECONDS = 60
+BUSY_BACKOFF_MAX_SECONDS = 60 * 30
+BUSY_MAX_REQUEUES = int(os.getenv("BUSY_MAX_REQUEUES", "8"))
+# Jobs abandoned by a dead worker are restarted (from their checkpoint) this often
+ABANDONED_MAX_REQUEUES = 2
+# Executions one worker process submits to or waits on at once, per service
+WPS_PROCESS_LIMITS = {
+    "chickadee": int(os.getenv("CHICKADEE_PROCESS_LIMIT", "4")),
+    "finch": int(os.getenv("FINCH_PROCESS_LIMIT", "4")),
+}
+
+# --- Async worker ---
+# "async" runs up to ASYNC_WORKER_JOBS jobs at once in one worker process,
+# one thread per job
+WORKER_MODE = os.getenv("WORKER_MODE", "sync")
+ASYNC_WORKER_JOBS = int(os.getenv("ASYNC_WORKER_JOBS", "4"))
+# How long an idle job slot waits on the queues before checking for shutdown
+ASYNC_DEQUEUE_TIMEOUT = 5
+
+# --- Worker autoscaling ---
+# worker_autoscaler.py keeps between these many worker processes running
+AUTOSCALE_MIN_WORKERS = int(os.getenv("AUTOSCALE_MIN_WORKERS", "1"))
+AUTOSCALE_MAX_WORKERS = int(os.getenv("AUTOSCALE_MAX_WORKERS", "2"))
+# Estimated runtime of waiting jobs (seconds) one job slot should have queued
+AUTOSCALE_BACKLOG_SECONDS = int(os.getenv("AUTOSCALE_BACKLOG_SECONDS", str(60 * 60)))
+AUTOSCALE_INTERVAL_SECONDS = 30
+# Workers are only stopped once fewer were needed for this long
+AUTOSCALE_SCALE_DOWN_DELAY_SECONDS = 60 * 10
+# Command starting one worker process (default: python -m panel_app.panel_UI.worker)
+AUTOSCALE_WORKER_COMMAND = os.getenv("AUTOSCALE_WORKER_COMMAND")
+
+# --- Job queues ---
+# Jobs go to the first queue whose runtime limit (seconds) covers their estimate
+JOB_QUEUES = [("small", 60 * 30), ("medium", 60 * 60 * 3), ("large", None)]
+# Jobs without an estimate
+DEFAULT_JOB_QUEUE = "medium"
+# Share of dequeues each queue gets while all of them have jobs waiting
+JOB_QUEUE_WEIGHTS = {"small": 6, "medium": 3, "large": 1}
+# A queue whose oldest job has waited this long is served first
+QUEUE_STARVATION_SECONDS = int(os.getenv("QUEUE_STARVATION_SECONDS", str(60 * 60 * 2)))
+# Jobs of one user queued or running at the same time; the rest wait their turn
+FAIR_SHARE_USER_INFLIGHT = int(os.getenv("FAIR_SHARE_USER_INFLIGHT", "2"))
+# Jobs kept ready on each RQ queue; the others wait in the per-user lists
+FAIR_SHARE_READY_JOBS = 1
+# Idle workers come back from the queues this often to release delayed jobs
+FAIR_SHARE_POLL_SECONDS = 15
+# Finished jobs per queue kept for the ETA shown to users
+JOB_DURATION_HISTORY = 100
+# Relaunching a job identical to one still waiting or running within this
+# window returns the existing job
+SUBMISSION_DEDUP_SECONDS = int(os.getenv("SUBMISSION_DEDUP_SECONDS", str(60 * 60 * 12)))
+
+# --- Job cost estimates ---
+# chickadee's max_gb (chunk size) is derived from the size of the downscaled
+# output, aiming for about CHICKADEE_TARGET_CHUNKS chunks. Chunks are never
+# smaller than CHICKADEE_MIN_GB (per-chunk overhead) unless the whole output
+# is, and never need more than CHICKADEE_MEMORY_GB of chickadee memory
+CHICKADEE_TARGET_CHUNKS = 8
+CHICKADEE_MIN_GB = float(os.getenv("CHICKADEE_MIN_GB", "0.25"))
+# Approximate peak chickadee memory per GB of chunk
+CHICKADEE_MEMORY_FACTOR = 4
+CHICKADEE_MEMORY_GB = float(os.getenv("CHICKADEE_MEMORY_GB", "4"))
+# max_gb of jobs launched without a cost estimate
+CHICKADEE_DEFAULT_GB = 0.5
+# Runtime model used until enough timings have been recorded:
+# seconds = overhead + rate * GB of downscaled data
+STAGE_RUNTIME_DEFAULTS = {
+    "downscale": {"overhead": 120, "seconds_per_gb": 1800},
+    "index": {"overhead": 30, "seconds_per_gb": 300},
+}
+STAGE_TIMING_HISTORY = 200
+STAGE_TIMING_MIN_SAMPLES = 5
+# RQ job timeout = estimated runtime * factor, within these bounds
+JOB_TIMEOUT_FACTOR = 3
+JOB_TIMEOUT_MIN_SECONDS = 60 * 60
+JOB_TIMEOUT_MAX_SECONDS = 60 * 60 * 12
+# Jobs estimated to fetch more than this are refused at launch (0 = no limit)
+MAX_JOB_FETCH_GB = float(os.getenv("MAX_JOB_FETCH_GB", "0"))
 
 
 PRISM_URL = f"{THREDDS_BASE}/storage/data/climate/PRISM/dataportal/pr_monClim_PRISM_historical_run1_198101-201012.nc"
 CANADA_MOSAIC_URL = f"{THREDDS_BASE}/storage/data/climate/observations/gridded/Canada_mosaic_30arcsec/pr_monClim_Canada_mosaic_30arcsec_198101-201012.nc"
 
 
+# --- Local caches ---
+# Shared by every server/worker process on a host (mount a volume to share across containers)
+CACHE_DIR = os.getenv("ODDS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "odds_cache"))
+MASK_INDEX_DIR = os.path.join(CACHE_DIR, "mask_index")
+CATALOG_INDEX_PATH = os.path.join(CACHE_DIR, "catalog_index.json")
+DATASET_METADATA_DIR = os.path.join(CACHE_DIR, "dataset_metadata")
+# Probes of datasets outside the CMIP6 catalog index (observations, PCIC-Blend)
+# are redone after this long
+DATASET_METADATA_TTL_SECONDS = int(
+    os.getenv("DATASET_METADATA_TTL_SECONDS", str(60 * 60 * 24))
+)
+# Wet-day percentile references, keyed by input URL, percentile and threshold;
+# least recently used files are evicted beyond PR_PERCENTILE_CACHE_MB. Kept in
+# the intermediate store when there is one, so finch fetches them by URL
+PR_PERCENTILE_CACHE_DIR = os.path.join(INTERMEDIATE_DIR or CACHE_DIR, "pr_percentile")
+PR_PERCENTILE_CACHE_MB = int(os.getenv("PR_PERCENTILE_CACHE_MB", "2048"))
+CATALOG_INDEX_REFRESH_SECONDS = int(
+    os.getenv("CATALOG_INDEX_REFRESH_SECONDS", str(60 * 60 * 6))
+)
+
+# Observation domains checked on every map click: name -> (url, varname)
+MASK_INDEX_DOMAINS = {
+    "canada_mosaic": (CANADA_MOSAIC_URL, "pr"),
+    "bc_prism": (PRISM_URL, "pr"),
+}
+
+
 def pcic_blend_url(gcm_var):
     return f"{THREDDS_BASE}/storage/data/climate/observations/gridded/PCIC_Blend/diagonal/{gcm_var}_day_PCIC_Blended_Observations_v1_1950-2012.nc"
 
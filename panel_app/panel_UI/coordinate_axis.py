@@ -0,0 +1,114 @@
+"""
+Process-wide cache of dataset coordinate axes (lat, lon, ...).
+
+Axes are read once per (dataset URL, variable) and kept in an LRU cache with a
+TTL, so map clicks and downscaling jobs don't re-download them over OPeNDAP.
+Lookups use binary search on the monotonic axis.
+
+This module only depends on numpy/netCDF4 so that the legacy notebook helpers
+can share it without loading the Panel app configuration.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+import numpy as np
+from netCDF4 import Dataset
+
+COORD_AXIS_CACHE_SIZE = int(os.getenv("COORD_AXIS_CACHE_SIZE", "64"))
+COORD_AXIS_TTL_SECONDS = int(os.getenv("COORD_AXIS_TTL_SECONDS", str(60 * 60 * 24)))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# netCDF4/libnetcdf is not thread-safe: hold this around any use of it from
+# code that may run in worker threads
+netcdf_lock = threading.RLock()
+
+
+class CoordinateAxis:
+    """A monotonic 1-D coordinate axis (ascending or descending)."""
+
+    def __init__(self, values):
+        values = np.asarray(np.ma.getdata(values), dtype="float64")
+        self.size = values.size
+        self.descending = self.size > 1 and values[0] > values[-1]
+        # Searches always run on the ascending view
+        self._ascending = values[::-1] if self.descending else values
+        self.values = values
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        return self.values[item]
+
+    def contains(self, value):
+        return self._ascending[0] <= value <= self._ascending[-1]
+
+    def nearest(self, value):
+        """
+        Index of the axis value closest to `value`. Ties resolve to the lower
+        index, matching np.argmin(np.abs(values - value)).
+        """
+        axis = self._ascending
+        i = int(np.searchsorted(axis, value))
+        if i == 0:
+            j = 0
+        elif i == self.size:
+            j = self.size - 1
+        else:
+            upper = axis[i] - value
+            lower = value - axis[i - 1]
+            if upper == lower:
+                # Lower index in the original ordering
+                j = i if self.descending else i - 1
+            else:
+                j = i if upper < lower else i - 1
+        return self.size - 1 - j if self.descending else j
+
+    def index_range(self, min_val, max_val):
+        """Indices of the axis values closest to `min_val` and `max_val`."""
+        return (self.nearest(min_val), self.nearest(max_val))
+
+
+def get_axis(url, varname, dataset=None):
+    """
+    Return the cached CoordinateAxis for `varname` in the dataset at `url`.
+    An already-open `dataset` is used for the read on a cache miss.
+    """
+    key = (url, varname)
+    now = monotonic()
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and now - entry[1] < COORD_AXIS_TTL_SECONDS:
+            _cache.move_to_end(key)
+            return entry[0]
+
+    with netcdf_lock:
+        if dataset is not None:
+            axis = CoordinateAxis(dataset.variables[varname][:])
+        else:
+            with Dataset(url) as ds:
+                axis = CoordinateAxis(ds.variables[varname][:])
+
+    with _cache_lock:
+        _cache[key] = (axis, now)
+        _cache.move_to_end(key)
+        while len(_cache) > COORD_AXIS_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return axis
+
+
+def clear_axis_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def get_index_range(arr, min_val, max_val):
+    """Compute the indices in an array that correspond to the array's values
+    closest to desired min/max values."""
+    if not isinstance(arr, CoordinateAxis):
+        arr = CoordinateAxis(arr)
+    return arr.index_range(min_val, max_val)
@@ -0,0 +1,156 @@
+"""
+Cached OPeNDAP header metadata (dimension lengths, variables, units, calendar).
+
+Only the DDS and DAS documents of a dataset are fetched, never its data. Probes
+are cached in memory and on disk under DATASET_METADATA_DIR, one JSON file per
+URL. Probes of files in the THREDDS catalog index are tagged with the
+fingerprint of their catalog directory and probed again once it changes;
+other files (observations, PCIC-Blend) are probed again after
+DATASET_METADATA_TTL_SECONDS.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from time import time
+import requests
+from .config import DATASET_METADATA_DIR, DATASET_METADATA_TTL_SECONDS
+from .catalog_index import catalog_entry_fingerprint
+
+# "Float64 time[time = 55115];" -> ("time", "55115") for every dimension
+DDS_DIM_RE = re.compile(r"\[\s*(\w+)\s*=\s*(\d+)\s*\]")
+DDS_VAR_RE = re.compile(
+    r"^\s*(?:Byte|Int8|UInt8|Int16|UInt16|Int32|UInt32|Int64|UInt64|"
+    r"Float32|Float64|String|Url)\s+(\w+)\s*\[",
+    re.MULTILINE,
+)
+DDS_GRID_RE = re.compile(r"^\s*\}\s*(\w+)\s*;", re.MULTILINE)
+DAS_ATTR_RE = re.compile(r'^\s*\w+\s+(\w+)\s+(.*);\s*$')
+
+_probes = {}
+_probes_lock = threading.Lock()
+
+
+def _get_text(url):
+    r = requests.get(url, timeout=60)
+    r.raise_for_status()
+    return r.text
+
+
+def parse_dds(text):
+    """Dimension lengths and variable names from a DDS document."""
+    dims = {name: int(size) for name, size in DDS_DIM_RE.findall(text)}
+    # The last closing brace names the dataset itself
+    body = text.strip().rsplit("}", 1)[0]
+    variables = []
+    for name in DDS_VAR_RE.findall(body) + DDS_GRID_RE.findall(body):
+        if name not in variables:
+            variables.append(name)
+    return dims, variables
+
+
+def parse_das(text):
+    """{variable: {attribute: value}} from a DAS document."""
+    attributes = {}
+    current = None
+    depth = 0
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.endswith("{"):
+            depth += 1
+            if depth == 2:
+                current = attributes.setdefault(stripped[:-1].strip(), {})
+        elif stripped == "}":
+            depth -= 1
+            if depth < 2:
+                current = None
+        elif current is not None and depth == 2:
+            match = DAS_ATTR_RE.match(stripped)
+            if match:
+                name, value = match.groups()
+                if value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1]
+                current[name] = value
+    return attributes
+
+
+def _cache_path(url):
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return os.path.join(DATASET_METADATA_DIR, f"{digest}.json")
+
+
+def _is_current(probe, url, fingerprint):
+    if probe.get("url") != url or probe.get("catalog") != fingerprint:
+        return False
+    if fingerprint is None:
+        return time() - probe.get("probed_at", 0) < DATASET_METADATA_TTL_SECONDS
+    return True
+
+
+def _read_cached(url, fingerprint):
+    try:
+        with open(_cache_path(url)) as f:
+            probe = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not _is_current(probe, url, fingerprint):
+        return None
+    return probe
+
+
+def _write_cached(probe):
+    path = _cache_path(probe["url"])
+    os.makedirs(DATASET_METADATA_DIR, exist_ok=True)
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp, "w") as f:
+        json.dump(probe, f)
+    os.replace(tmp, path)
+
+
+def probe_dataset(url):
+    """
+    Header metadata of the OPeNDAP dataset at `url`:
+    {"url", "catalog", "probed_at", "dims": {name: length}, "variables": [...],
+     "attributes": {variable: {attribute: value}}}
+    """
+    fingerprint = catalog_entry_fingerprint(url)
+    with _probes_lock:
+        probe = _probes.get(url)
+    if probe is not None and _is_current(probe, url, fingerprint):
+        return probe
+
+    probe = _read_cached(url, fingerprint)
+    if probe is None:
+        print(f"Probing dataset metadata: {url}")
+        dims, variables = parse_dds(_get_text(f"{url}.dds"))
+        probe = {
+            "url": url,
+            "catalog": fingerprint,
+            "probed_at": time(),
+            "dims": dims,
+            "variables": variables,
+            "attributes": parse_das(_get_text(f"{url}.das")),
+        }
+        try:
+            _write_cached(probe)
+        except OSError as e:
+            print(f"❗ Could not cache dataset metadata for {url}: {e}")
+
+    with _probes_lock:
+        _probes[url] = probe
+    return probe
+
+
+def dim_length(url, dim):
+    return probe_dataset(url)["dims"][dim]
+
+
+def time_metadata(url):
+    """{"units", "calendar"} of the time axis of the dataset at `url`."""
+    time_attrs = probe_dataset(url)["attributes"].get("time", {})
+    return {
+        "units": time_attrs["units"],
+        "calendar": time_attrs.get("calendar", "standard"),
+    }
@@ -0,0 +1,319 @@
+"""
+Per-user fair-share dispatch of ODDS jobs.
+
+Launch does not put jobs straight on an RQ queue. submit_job saves the job
+and appends it to the submitting user's pending list for its cost queue.
+dispatch() moves pending jobs onto the RQ queues one user at a time in
+round-robin order, skipping users who already have FAIR_SHARE_USER_INFLIGHT
+jobs queued or running. Each RQ queue only holds FAIR_SHARE_READY_JOBS jobs, so
+the round-robin decides the order jobs start in.
+
+dispatch() runs after every submission, in the worker before and right after
+each dequeue (refilling the queue the other idle workers are blocked on), and
+as a job finishes or fails (job_finished), so a user dropping below the cap
+gets their next job queued without waiting for another submission.
+
+Jobs submitted with a delay (a job continuing after a ServerBusy backoff) wait
+in a sorted set until their time, then join their user's pending list like any
+other submission; idle workers check for them every FAIR_SHARE_POLL_SECONDS.
+
+submit_job_once makes launches idempotent: a submission whose key
+(submission_key: the user and the normalized job_params) matches a job still
+waiting or running within SUBMISSION_DEDUP_SECONDS returns that job instead.
+"""
+
+import json
+import math
+from collections import Counter
+from time import monotonic, time
+import redis
+from rq.job import Job, JobStatus
+from rq.registry import StartedJobRegistry
+from .config import (
+    REDIS_URL,
+    FAIR_SHARE_USER_INFLIGHT,
+    FAIR_SHARE_READY_JOBS,
+    FAIR_SHARE_POLL_SECONDS,
+    SUBMISSION_DEDUP_SECONDS,
+)
+from .job_queues import JOB_QUEUE_NAMES, WeightedWorker, get_job_queue
+from .result_cache import canonical_key
+
+conn = redis.from_url(REDIS_URL)
+
+DISPATCH_LOCK_KEY = "odds:fair:lock"
+# {job id: time at which it joins its user's pending list}
+DELAYED_KEY = "odds:fair:delayed"
+
+
+def _users_key(queue_name):
+    """Round-robin ring of the users with pending jobs in a queue."""
+    return f"odds:fair:{queue_name}:users"
+
+
+def _pending_key(queue_name, user):
+    return f"odds:fair:{queue_name}:pending:{user}"
+
+
+def _dispatch_lock(connection):
+    return connection.lock(DISPATCH_LOCK_KEY, timeout=30, blocking_timeout=30)
+
+
+def _add_pending(connection, queue_name, user_email, job_id):
+    connection.rpush(_pending_key(queue_name, user_email), job_id)
+    if connection.lpos(_users_key(queue_name), user_email) is None:
+        connection.rpush(_users_key(queue_name), user_email)
+
+
+def submit_job(
+    queue_name, func, args, user_email, meta=None, connection=None, delay=0, **job_kwargs
+):
+    """
+    Create an RQ job and queue it for fair-share dispatch, after `delay`
+    seconds if given. Returns the job.
+    """
+    connection = connection or conn
+    queue = get_job_queue(queue_name, connection)
+    job = queue.create_job(
+        func,
+        args=args,
+        meta=dict(meta or {}, user_email=user_email),
+        status=JobStatus.SCHEDULED if delay > 0 else JobStatus.CREATED,
+        **job_kwargs,
+    )
+    job.save()
+    with _dispatch_lock(connection):
+        # Delayed jobs that are due were submitted before this one
+        _release_delayed(connection)
+        if delay > 0:
+            connection.zadd(DELAYED_KEY, {job.id: time() + delay})
+        else:
+            _add_pending(connection, queue_name, user_email, job.id)
+    dispatch(connection)
+    return job
+
+
+def _release_delayed(connection):
+    """Move the delayed jobs whose time has come to their users' pending lists."""
+    for job_id in connection.zrangebyscore(DELAYED_KEY, 0, time()):
+        connection.zrem(DELAYED_KEY, job_id)
+        job = Job.fetch_many([job_id.decode()], connection=connection)[0]
+        if job is None or job.get_status(refresh=False) != JobStatus.SCHEDULED:
+            # Deleted or canceled meanwhile
+            continue
+        job.set_status(JobStatus.CREATED)
+        _add_pending(connection, job.origin, job.meta.get("user_email"), job.id)
+
+
+def submission_key(user_email, job_params):
+    """Idempotency key of a launch: the user and the normalized job_params."""
+    # The cost estimate changes with the recorded timings; it's not part of the request
+    params = {k: v for k, v in job_params.items() if k not in ("cost", "user_email")}
+    params["downscale_jobs"] = sorted(
+        params.get("downscale_jobs", []), key=lambda p: p["clim_var"]
+    )
+    if params.get("output_intent", "downscale") == "downscale":
+        params["index_jobs"] = []
+    params["index_jobs"] = sorted(
+        params.get("index_jobs", []),
+        key=lambda p: json.dumps(p, sort_keys=True, default=str),
+    )
+    return canonical_key(
+        "submission", {"user": user_email.strip().lower(), "job_params": params}
+    )
+
+
+def _submission_key(key):
+    return f"odds:submission:{key}"
+
+
+def _active_job(job_id, connection):
+    """The job `job_id` (or the job it was requeued as) if still waiting or running."""
+    if job_id is None:
+        return None
+    job = Job.fetch_many([job_id.decode()], connection=connection)[0]
+    # Jobs refused by a busy service continue as a rescheduled job
+    while job is not None and job.meta.get("requeued_as"):
+        job = Job.fetch_many([job.meta["requeued_as"]], connection=connection)[0]
+    active = (
+        JobStatus.CREATED,
+        JobStatus.QUEUED,
+        JobStatus.STARTED,
+        JobStatus.SCHEDULED,
+        JobStatus.DEFERRED,
+    )
+    if job is None or job.get_status(refresh=False) not in active:
+        return None
+    return job
+
+
+def submit_job_once(key, queue_name, func, args, user_email, **kwargs):
+    """
+    submit_job, unless a job submitted with the same `key` is still waiting or
+    running. Returns (job, created).
+    """
+    connection = kwargs.get("connection") or conn
+    submission = _submission_key(key)
+    with connection.lock(f"{submission}:lock", timeout=30, blocking_timeout=30):
+        existing = _active_job(connection.get(submission), connection)
+        if existing is not None:
+            return existing, False
+        job = submit_job(queue_name, func, args, user_email, **kwargs)
+        connection.set(submission, job.id, ex=SUBMISSION_DEDUP_SECONDS)
+    return job, True
+
+
+def _inflight_by_user(connection, finished=(), starting=()):
+    """
+    Jobs per user that are ready on an RQ queue or running, except the
+    `finished` job ids, plus the `starting` jobs (dequeued by a worker but not
+    yet in the started registry).
+    """
+    job_ids = []
+    for name in JOB_QUEUE_NAMES:
+        queue = get_job_queue(name, connection)
+        job_ids += queue.get_job_ids()
+        job_ids += StartedJobRegistry(queue=queue).get_job_ids()
+    jobs = Job.fetch_many(list(dict.fromkeys(job_ids)), connection=connection)
+    # The started registry is only cleaned periodically
+    active = (JobStatus.QUEUED, JobStatus.STARTED)
+    jobs = {
+        job.id: job
+        for job in jobs
+        if job is not None
+        and job.id not in finished
+        and job.get_status(refresh=False) in active
+    }
+    for job in starting:
+        jobs.setdefault(job.id, job)
+    return Counter(job.meta.get("user_email") for job in jobs.values())
+
+
+def pending_job_ids(connection=None):
+    """Ids of the jobs waiting for fair-share dispatch, in all queues."""
+    connection = connection or conn
+    job_ids = []
+    for name in JOB_QUEUE_NAMES:
+        for user in connection.lrange(_users_key(name), 0, -1):
+            pending = connection.lrange(_pending_key(name, user.decode()), 0, -1)
+            job_ids += [job_id.decode() for job_id in pending]
+    return job_ids
+
+
+def _next_job(queue_name, inflight, connection):
+    """Pop the next job of the round-robin, or None if no user may start one."""
+    users_key = _users_key(queue_name)
+    for _ in range(connection.llen(users_key)):
+        # Rotate: the user picked (or skipped) now goes to the back of the ring
+        user = connection.lmove(users_key, users_key, "LEFT", "RIGHT")
+        if user is None:
+            return None
+        user = user.decode()
+        pending_key = _pending_key(queue_name, user)
+        if inflight[user] >= FAIR_SHARE_USER_INFLIGHT:
+            continue
+        job_id = connection.lpop(pending_key)
+        if connection.llen(pending_key) == 0:
+            connection.lrem(users_key, 0, user)
+        if job_id is None:
+            continue
+        try:
+            return Job.fetch(job_id.decode(), connection=connection)
+        except Exception as e:
+            print(f"❗ Dropping pending job {job_id.decode()}: {e}")
+    return None
+
+
+def dispatch(connection=None, finished=(), starting=()):
+    """
+    Move pending jobs onto the RQ queues in fair-share order. Jobs in
+    `finished` are about to end and don't count as in flight; the `starting`
+    jobs, just dequeued, do.
+    """
+    connection = connection or conn
+    with _dispatch_lock(connection):
+        _release_delayed(connection)
+        inflight = _inflight_by_user(connection, finished, starting)
+        for name in JOB_QUEUE_NAMES:
+            queue = get_job_queue(name, connection)
+            while queue.count < FAIR_SHARE_READY_JOBS:
+                job = _next_job(name, inflight, connection)
+                if job is None:
+                    break
+                queue.enqueue_job(job)
+                inflight[job.meta.get("user_email")] += 1
+
+
+def job_finished(job):
+    """
+    Dispatch for the user of `job`, which is finishing or failing. RQ only
+    updates its status after the job function and callbacks return.
+    """
+    try:
+        dispatch(job.connection, finished=(job.id,))
+    except redis.RedisError as e:
+        print(f"❗ Fair-share dispatch failed: {e}")
+
+
+def get_queue_position(job, queue_name, connection=None):
+    """
+    1-based position of `job` in its queue, in the order jobs will be
+    dispatched (per-user round-robin, ignoring the in-flight cap), or None if
+    it is no longer waiting.
+    """
+    connection = connection or conn
+    queue = get_job_queue(queue_name, connection)
+    ready = queue.get_job_position(job)
+    if ready is not None:
+        return ready + 1
+
+    user = job.meta.get("user_email")
+    rank = connection.lpos(_pending_key(queue_name, user), job.id)
+    if rank is None:
+        return None
+    # Each round of the ring dispatches one job per user, starting at its head
+    ring = [u.decode() for u in connection.lrange(_users_key(queue_name), 0, -1)]
+    pipe = connection.pipeline(transaction=False)
+    for other in ring:
+        pipe.llen(_pending_key(queue_name, other))
+    ahead = queue.count + rank
+    before_user = True
+    for other, pending in zip(ring, pipe.execute()):
+        if other == user:
+            before_user = False
+            continue
+        ahead += min(pending, rank + 1 if before_user else rank)
+    return ahead + 1
+
+
+class FairShareWorker(WeightedWorker):
+    """
+    WeightedWorker that tops up the queues from the fair-share lists before
+    dequeuing, and again as soon as it took a job: the other idle workers are
+    blocked on the queues and only get work from their refill. Idle workers
+    come back every FAIR_SHARE_POLL_SECONDS to release delayed jobs.
+    """
+
+    def _dispatch(self, starting=()):
+        try:
+            dispatch(self.connection, starting=starting)
+        except redis.RedisError as e:
+            print(f"❗ Fair-share dispatch failed: {e}")
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        deadline = None if max_idle_time is None else monotonic() + max_idle_time
+        while True:
+            self._dispatch()
+            if timeout is None:
+                # Burst mode: a single non-blocking attempt
+                result = super().dequeue_job_and_maintain_ttl(None, max_idle_time)
+            else:
+                idle = FAIR_SHARE_POLL_SECONDS
+                if deadline is not None:
+                    idle = min(idle, max(math.ceil(deadline - monotonic()), 1))
+                result = super().dequeue_job_and_maintain_ttl(min(timeout, idle), idle)
+            if result is not None:
+                self._dispatch(starting=(result[0],))
+                return result
+            if timeout is None or (deadline is not None and monotonic() >= deadline):
+                return None
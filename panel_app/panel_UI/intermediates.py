@@ -0,0 +1,232 @@
+"""
+Store of intermediate files computed by the worker and read by the WPS
+services (the local tasmean for chickadee, the pr percentile for finch).
+
+Files are written under INTERMEDIATE_DIR, a directory published by a web
+server at INTERMEDIATE_BASE_URL, and passed to the services as URL
+references: the service fetches the file itself, instead of birdy embedding
+a local file in the Execute request (whole NetCDF files in the request XML,
+which remote services may reject).
+
+Cached files (keyed by their inputs) are computed once per key at a time
+(path_lock) and bounded in size by evict_lru. A job using a cached file pins
+it (pin / release_pins) for as long as it, or a service it passed the file
+to, may read it; evict_lru only removes unpinned files. Pins are leases in
+Redis renewed by a thread of the holding process, so the pins of a worker
+that died lapse after INTERMEDIATE_PIN_LEASE_SECONDS.
+
+For development the directory can be served with
+
+    python -m panel_app.panel_UI.intermediates [port]
+"""
+
+import os
+import sys
+import threading
+import uuid
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+from time import sleep, time
+import redis
+from .config import (
+    INTERMEDIATE_DIR,
+    INTERMEDIATE_BASE_URL,
+    INTERMEDIATE_PIN_LEASE_SECONDS,
+    REDIS_URL,
+)
+
+# Unpinned files used this recently are not evicted either: an execution
+# reattached by a requeued job reads its inputs without holding pins
+EVICT_MIN_AGE_SECONDS = 60 * 30
+
+conn = redis.from_url(REDIS_URL)
+
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+# Pins held by this process, {token: pins key}, renewed by _renew_pins
+_held_pins = {}
+_held_lock = threading.Lock()
+_renewer = None
+
+
+def store_enabled():
+    return bool(INTERMEDIATE_DIR and INTERMEDIATE_BASE_URL)
+
+
+def require_store(feature):
+    if not store_enabled():
+        raise ValueError(
+            f"{feature} requires INTERMEDIATE_DIR and INTERMEDIATE_BASE_URL."
+        )
+
+
+def _relative_path(path):
+    """`path` relative to INTERMEDIATE_DIR, or None if it is outside."""
+    if not store_enabled():
+        return None
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(INTERMEDIATE_DIR))
+    if rel == os.curdir or rel.split(os.sep)[0] == os.pardir:
+        return None
+    return rel
+
+
+def intermediate_path(name):
+    return os.path.join(INTERMEDIATE_DIR, name)
+
+
+def intermediate_url(path):
+    """URL at which the file `path`, under INTERMEDIATE_DIR, is served."""
+    rel = _relative_path(path)
+    if rel is None:
+        raise ValueError(f"{path} is not in the intermediate store.")
+    return f"{INTERMEDIATE_BASE_URL.rstrip('/')}/{quote(rel.replace(os.sep, '/'))}"
+
+
+def service_input(path):
+    """
+    What to pass a WPS service for the local file `path`: its URL if it is in
+    the intermediate store, else the path itself (birdy then embeds the file).
+    """
+    if _relative_path(path) is None:
+        print(f"⚠️ {path} is not served from INTERMEDIATE_DIR; embedding it in the request")
+        return path
+    return intermediate_url(path)
+
+
+def path_lock(path):
+    """Lock of the process for computing the file `path`."""
+    with _path_locks_lock:
+        return _path_locks.setdefault(path, threading.Lock())
+
+
+def _pins_key(path):
+    return f"odds:intermediate:pins:{os.path.abspath(path)}"
+
+
+def _evict_lock(directory):
+    # Taken by evict_lru for a sweep and by pin, so a file is never removed
+    # between a job pinning it and reading it
+    return conn.lock(
+        f"odds:intermediate:evict:{os.path.abspath(directory)}",
+        timeout=60,
+        blocking_timeout=30,
+    )
+
+
+def _renew_pins():
+    while True:
+        sleep(INTERMEDIATE_PIN_LEASE_SECONDS / 3)
+        with _held_lock:
+            held = list(_held_pins.items())
+        if not held:
+            continue
+        try:
+            pipe = conn.pipeline(transaction=False)
+            for token, key in held:
+                pipe.zadd(key, {token: time() + INTERMEDIATE_PIN_LEASE_SECONDS}, xx=True)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"❗ Could not renew intermediate pins: {e}")
+
+
+def pin(path):
+    """
+    Keep `path` from being evicted until release_pins. Returns the token (None
+    if Redis is unavailable; the file is then only protected by its age).
+    Pin before checking that the file exists.
+    """
+    global _renewer
+    token = uuid.uuid4().hex
+    key = _pins_key(path)
+    try:
+        with _evict_lock(os.path.dirname(path)):
+            conn.zadd(key, {token: time() + INTERMEDIATE_PIN_LEASE_SECONDS})
+    except redis.RedisError as e:
+        print(f"❗ Could not pin {path}: {e}")
+        return None
+    with _held_lock:
+        _held_pins[token] = key
+        if _renewer is None or not _renewer.is_alive():
+            _renewer = threading.Thread(
+                target=_renew_pins, name="intermediate-pins", daemon=True
+            )
+            _renewer.start()
+    return token
+
+
+def release_pins(pins):
+    """Release the (path, token) pins of a job; empties `pins`."""
+    while pins:
+        path, token = pins.pop()
+        if token is None:
+            continue
+        with _held_lock:
+            _held_pins.pop(token, None)
+        try:
+            conn.zrem(_pins_key(path), token)
+        except redis.RedisError as e:
+            print(f"❗ Could not unpin {path}: {e}")
+
+
+def _is_pinned(path):
+    key = _pins_key(path)
+    pipe = conn.pipeline()
+    pipe.zremrangebyscore(key, 0, time())
+    pipe.zcard(key)
+    return pipe.execute()[-1] > 0
+
+
+def evict_lru(directory, limit_mb):
+    """
+    Remove the least recently used (oldest modification time) unpinned .nc
+    files of `directory` until they fit in `limit_mb`.
+    """
+    entries = []
+    for name in os.listdir(directory):
+        if not name.endswith(".nc"):
+            continue
+        try:
+            st = os.stat(os.path.join(directory, name))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    limit = limit_mb * 2**20
+    if total <= limit:
+        return
+    now = time()
+    try:
+        with _evict_lock(directory):
+            for mtime, size, name in sorted(entries):
+                if total <= limit:
+                    break
+                path = os.path.join(directory, name)
+                if now - mtime < EVICT_MIN_AGE_SECONDS or _is_pinned(path):
+                    continue
+                try:
+                    os.remove(path)
+                    total -= size
+                except FileNotFoundError:
+                    pass
+    except redis.RedisError as e:
+        # Without the pins nothing is known to be safe to remove
+        print(f"❗ Could not evict from {directory}: {e}")
+
+
+def serve(port=8000, bind=""):
+    """Serve INTERMEDIATE_DIR over HTTP (development; use a real web server in production)."""
+    require_store("Serving intermediates")
+    os.makedirs(INTERMEDIATE_DIR, exist_ok=True)
+    handler = partial(SimpleHTTPRequestHandler, directory=INTERMEDIATE_DIR)
+    with ThreadingHTTPServer((bind, port), handler) as server:
+        print(f"Serving {INTERMEDIATE_DIR} on port {port} (as {INTERMEDIATE_BASE_URL})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
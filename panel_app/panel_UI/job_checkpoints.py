@@ -0,0 +1,83 @@
+"""
+Per-job checkpoints of finished stages.
+
+Each stage result (downscale output URLs, index output lines) is stored in a
+Redis hash under the job's checkpoint ID as soon as the stage completes. When a
+job runs again under the same checkpoint (RQ requeue of a failed or timed-out
+job, ServerBusy requeue, or retry_failed_stages) the stages already in the
+hash are skipped. Stages that were still waiting on a WPS execution attach to
+it again through its coalesce record.
+
+Retry the failed stages of a job by hand with:
+
+    python -m panel_app.panel_UI.job_checkpoints <job_id>
+"""
+
+import json
+import sys
+import redis
+from rq.job import Job
+from .config import OUTPUT_RETENTION_SECONDS
+from .fair_share import submit_job
+from .result_cache import conn
+
+
+def checkpoint_id(job):
+    """Jobs created to continue another job share its checkpoint."""
+    return job.meta.get("checkpoint_id", job.id)
+
+
+def _stages_key(checkpoint):
+    return f"odds:job:{checkpoint}:stages"
+
+
+def load_stages(checkpoint):
+    """{stage key: result} of the stages finished under `checkpoint`."""
+    try:
+        raw = conn.hgetall(_stages_key(checkpoint))
+    except redis.RedisError as e:
+        print(f"❗ Could not load checkpoint {checkpoint}: {e}")
+        return {}
+    return {key.decode(): json.loads(value) for key, value in raw.items()}
+
+
+def save_stage(checkpoint, key, result):
+    try:
+        conn.hset(_stages_key(checkpoint), key, json.dumps(result))
+        # Outputs are purged after the retention period, so are checkpoints
+        conn.expire(_stages_key(checkpoint), OUTPUT_RETENTION_SECONDS)
+    except redis.RedisError as e:
+        print(f"❗ Could not checkpoint stage {key} of {checkpoint}: {e}")
+
+
+def retry_failed_stages(job_id, connection=None):
+    """
+    Run a job again, skipping the stages it already finished: a new job
+    sharing its checkpoint waits its turn in the user's fair-share list.
+    Returns the ID of the job that will run.
+    """
+    job = Job.fetch(job_id, connection=connection or conn)
+    new_job = submit_job(
+        job.origin,
+        job.func_name,
+        job.args,
+        job.meta.get("user_email"),
+        meta=dict(
+            {k: v for k, v in job.meta.items() if k != "requeued_as"},
+            checkpoint_id=checkpoint_id(job),
+            retried_from=job.id,
+        ),
+        connection=job.connection,
+        timeout=job.timeout,
+        result_ttl=job.result_ttl,
+        on_failure=job.failure_callback,
+    )
+    # Status lookups of the old job follow it to the new one
+    job.meta["requeued_as"] = new_job.id
+    job.save_meta()
+    return new_job.id
+
+
+if __name__ == "__main__":
+    for arg in sys.argv[1:]:
+        print(f"{arg} -> {retry_failed_stages(arg)}")
@@ -0,0 +1,200 @@
+"""
+Cost estimates of ODDS jobs.
+
+estimate_job_cost turns job_params into the data fetched, the chickadee memory
+and the expected runtime of every stage, using the grid metadata of the input
+files (cached coordinate axes and DDS/DAS probes) and the stage timings
+recorded by the worker. Launch shows the estimate and stores it with the job;
+the worker derives chickadee's max_gb from it, and the RQ job timeout is set
+from it at enqueue.
+"""
+
+import json
+from statistics import median
+import redis
+from .config import (
+    REDIS_URL,
+    CHICKADEE_MIN_GB,
+    CHICKADEE_TARGET_CHUNKS,
+    CHICKADEE_MEMORY_FACTOR,
+    CHICKADEE_MEMORY_GB,
+    STAGE_RUNTIME_DEFAULTS,
+    STAGE_TIMING_HISTORY,
+    STAGE_TIMING_MIN_SAMPLES,
+    JOB_TIMEOUT_FACTOR,
+    JOB_TIMEOUT_MIN_SECONDS,
+    JOB_TIMEOUT_MAX_SECONDS,
+    DOWNSCALE_CONCURRENCY,
+    INDEX_CONCURRENCY,
+    FINCH_CAPACITY,
+)
+from .coordinate_axis import get_axis
+from .dataset_metadata import dim_length, time_metadata
+from .job_graph import build_job_graph
+from .panel_helpers import get_index_range, resolve_downscaling_inputs
+
+conn = redis.from_url(REDIS_URL)
+
+GB = 1024**3
+# Values are decoded to float32 by the services
+BYTES_PER_VALUE = 4
+# The observations are monthly climatologies
+OBS_TIMESTEPS = 12
+DAYS_PER_YEAR = {
+    "360_day": 360,
+    "365_day": 365,
+    "noleap": 365,
+    "366_day": 366,
+    "all_leap": 366,
+}
+
+
+def _timings_key(kind):
+    return f"odds:timings:{kind}"
+
+
+def record_stage_timing(kind, gb, seconds):
+    """Remember how long a stage of `kind` took on `gb` of downscaled data."""
+    try:
+        conn.lpush(_timings_key(kind), json.dumps({"gb": gb, "seconds": seconds}))
+        conn.ltrim(_timings_key(kind), 0, STAGE_TIMING_HISTORY - 1)
+    except redis.RedisError as e:
+        print(f"❗ Could not record stage timing: {e}")
+
+
+def _seconds_per_gb(kind):
+    defaults = STAGE_RUNTIME_DEFAULTS[kind]
+    try:
+        samples = [json.loads(raw) for raw in conn.lrange(_timings_key(kind), 0, -1)]
+    except redis.RedisError as e:
+        print(f"❗ Stage timings unavailable: {e}")
+        samples = []
+    rates = [
+        max(s["seconds"] - defaults["overhead"], 0) / s["gb"]
+        for s in samples
+        if s["gb"] > 0
+    ]
+    if len(rates) < STAGE_TIMING_MIN_SAMPLES:
+        return defaults["seconds_per_gb"]
+    return median(rates)
+
+
+def estimate_stage_runtime(kind, gb, rate=None):
+    if rate is None:
+        rate = _seconds_per_gb(kind)
+    return STAGE_RUNTIME_DEFAULTS[kind]["overhead"] + rate * gb
+
+
+def _grid_cells(url, bounds, grid):
+    """Number of grid cells of `url` inside the `grid` ("gcm" | "obs") box."""
+    lat = sorted(
+        get_index_range(
+            get_axis(url, "lat"), bounds[f"lat_min_{grid}"], bounds[f"lat_max_{grid}"]
+        )
+    )
+    lon = sorted(
+        get_index_range(
+            get_axis(url, "lon"), bounds[f"lon_min_{grid}"], bounds[f"lon_max_{grid}"]
+        )
+    )
+    return (lat[1] - lat[0] + 1) * (lon[1] - lon[0] + 1)
+
+
+def _n_timesteps(ds_params, gcm_file):
+    if ds_params["dataset"].split(" ")[0] == "PCIC-Blend":
+        return dim_length(gcm_file, "time")
+    start, end = ds_params["period"].split("-")
+    calendar = time_metadata(gcm_file)["calendar"]
+    return int((int(end) - int(start) + 1) * DAYS_PER_YEAR.get(calendar, 365.25))
+
+
+def chickadee_max_gb(output_gb):
+    """Chunk size (max_gb) for chickadee to downscale `output_gb` of output."""
+    # Small outputs are downscaled in one chunk
+    smallest = min(output_gb, CHICKADEE_MIN_GB)
+    # Largest chunk within chickadee's memory
+    largest = CHICKADEE_MEMORY_GB / CHICKADEE_MEMORY_FACTOR
+    return max(min(max(output_gb / CHICKADEE_TARGET_CHUNKS, smallest), largest), 0.001)
+
+
+def estimate_downscale_cost(ds_params, rate=None):
+    gcm_file, obs_file, gcm_var, obs_var = resolve_downscaling_inputs(ds_params)
+    bounds = ds_params.get("bounds") or {}
+    ntime = _n_timesteps(ds_params, gcm_file)
+    gcm_cells = _grid_cells(gcm_file, bounds, "gcm")
+    obs_cells = _grid_cells(obs_file, bounds, "obs")
+
+    # tasmean reads both tasmax and tasmin
+    gcm_inputs = 2 if ds_params["clim_var"] == "tasmean" else 1
+    fetch_bytes = (
+        gcm_cells * ntime * gcm_inputs + obs_cells * OBS_TIMESTEPS
+    ) * BYTES_PER_VALUE
+    output_gb = obs_cells * ntime * BYTES_PER_VALUE / GB
+    max_gb = chickadee_max_gb(output_gb)
+    return {
+        "fetch_gb": fetch_bytes / GB,
+        "output_gb": output_gb,
+        "max_gb": round(max_gb, 3),
+        "memory_gb": max_gb * CHICKADEE_MEMORY_FACTOR,
+        "runtime_seconds": estimate_stage_runtime("downscale", output_gb, rate),
+    }
+
+
+def estimate_job_cost(job_params):
+    """
+    {"fetch_gb", "memory_gb", "runtime_seconds", "stages": {stage key: cost}}
+    for a job. Stage keys are those of job_graph.build_job_graph.
+    """
+    nodes = build_job_graph(job_params)
+    rates = {kind: _seconds_per_gb(kind) for kind in STAGE_RUNTIME_DEFAULTS}
+    stages = {}
+    for key, node in nodes.items():
+        if node["kind"] == "downscale":
+            stages[key] = estimate_downscale_cost(node["params"], rates["downscale"])
+    for key, node in nodes.items():
+        if node["kind"] == "index":
+            input_gb = sum(stages[dep]["output_gb"] for dep in node["deps"])
+            stages[key] = {
+                "input_gb": input_gb,
+                "runtime_seconds": estimate_stage_runtime(
+                    "index", input_gb, rates["index"]
+                ),
+            }
+
+    downscale_runtimes = [
+        stages[k]["runtime_seconds"] for k, n in nodes.items() if n["kind"] == "downscale"
+    ]
+    index_runtimes = [
+        stages[k]["runtime_seconds"] for k, n in nodes.items() if n["kind"] == "index"
+    ]
+    # Stages of a kind run up to the worker's concurrency limits at once, and
+    # indices also share finch's capacity
+    index_concurrency = min(INDEX_CONCURRENCY, FINCH_CAPACITY)
+    runtime = max(
+        max(downscale_runtimes, default=0),
+        sum(downscale_runtimes) / DOWNSCALE_CONCURRENCY,
+    ) + max(max(index_runtimes, default=0), sum(index_runtimes) / index_concurrency)
+    return {
+        "fetch_gb": sum(s.get("fetch_gb", 0) for s in stages.values()),
+        "memory_gb": max((s.get("memory_gb", 0) for s in stages.values()), default=0),
+        "runtime_seconds": runtime,
+        "stages": stages,
+    }
+
+
+def job_timeout(cost):
+    """RQ job timeout (seconds) for an estimated cost."""
+    timeout = int(cost["runtime_seconds"] * JOB_TIMEOUT_FACTOR)
+    return min(max(timeout, JOB_TIMEOUT_MIN_SECONDS), JOB_TIMEOUT_MAX_SECONDS)
+
+
+def format_cost(cost):
+    minutes = max(round(cost["runtime_seconds"] / 60), 1)
+    runtime = f"{minutes} min" if minutes < 90 else f"{minutes / 60:.1f} h"
+    fetch_gb = cost["fetch_gb"]
+    fetched = f"{fetch_gb:.1f} GB" if fetch_gb >= 1 else f"{fetch_gb * 1024:.0f} MB"
+    return (
+        f"Estimated data fetched: {fetched}, "
+        f"peak downscaling memory: {cost['memory_gb']:.1f} GB, "
+        f"processing time once started: about {runtime}"
+    )
@@ -0,0 +1,110 @@
+"""
+Dependency graph of the stages of an ODDS job.
+
+Every downscaled variable is a "downscale" node and every requested index is an
+"index" node depending on the variables it is computed from (see
+panel_helpers.index_input_variables). run_job_graph starts each node as soon as
+its inputs are done, so indices on one variable run while other variables are
+still being downscaled.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from .panel_helpers import index_input_variables
+
+
+def downscale_key(clim_var):
+    return f"downscale:{clim_var}"
+
+
+def index_key(position):
+    return f"index:{position}"
+
+
+def build_job_graph(job_params):
+    """
+    Return {key: node} for the job, where a node is a dict with its "key",
+    "kind" ("downscale" | "index"), "params", "deps" (keys of its inputs) and
+    "cost" (its job_cost estimate, if the job has one).
+    """
+    nodes = {}
+    for ds_params in job_params.get("downscale_jobs", []):
+        nodes[downscale_key(ds_params["clim_var"])] = {
+            "kind": "downscale",
+            "params": ds_params,
+            "deps": [],
+        }
+
+    output_intent = job_params.get("output_intent", "downscale")
+    if output_intent in ("indices", "both"):
+        for i, ix_params in enumerate(job_params.get("index_jobs", [])):
+            inputs = index_input_variables(
+                ix_params["variable"], ix_params["func_name"]
+            )
+            # Missing inputs are reported by run_single_index ("No input file")
+            deps = [downscale_key(v) for v in inputs if downscale_key(v) in nodes]
+            nodes[index_key(i)] = {"kind": "index", "params": ix_params, "deps": deps}
+
+    stage_costs = (job_params.get("cost") or {}).get("stages", {})
+    for key, node in nodes.items():
+        node["key"] = key
+        node["cost"] = stage_costs.get(key)
+    return nodes
+
+
+def run_job_graph(nodes, run_node, limits, completed=None, on_result=None):
+    """
+    Run every node of the graph with `run_node(node, dep_results)`, where
+    `dep_results` is the list of results of the node's dependencies. At most
+    `limits[kind]` nodes of each kind run at the same time.
+
+    Nodes in `completed` ({key: result}, e.g. from a checkpoint) are not run
+    again. `on_result(key, result)` is called as each node finishes.
+
+    Returns {key: result}. If a node raises, no further nodes are started and
+    the exception is re-raised once the running ones have finished.
+    """
+    results = {
+        key: result for key, result in (completed or {}).items() if key in nodes
+    }
+    pending = {key: node for key, node in nodes.items() if key not in results}
+    running = {}
+    active = {kind: 0 for kind in limits}
+
+    with ThreadPoolExecutor(max_workers=max(1, sum(limits.values()))) as pool:
+        while pending or running:
+            for key, node in list(pending.items()):
+                kind = node["kind"]
+                ready = all(dep in results for dep in node["deps"])
+                if ready and active[kind] < limits[kind]:
+                    dep_results = [results[dep] for dep in node["deps"]]
+                    running[pool.submit(run_node, node, dep_results)] = key
+                    active[kind] += 1
+                    del pending[key]
+
+            if not running:
+                raise RuntimeError(f"Unresolvable job stages: {sorted(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                active[nodes[key]["kind"]] -= 1
+                try:
+                    results[key] = future.result()
+                except Exception:
+                    # Let the stages already submitted finish, then fail the job
+                    pending.clear()
+                    for other in running:
+                        other.cancel()
+                    wait(running)
+                    # Stages that still succeeded are reported (and checkpointed)
+                    for other, other_key in running.items():
+                        if other.cancelled() or other.exception() is not None:
+                            continue
+                        results[other_key] = other.result()
+                        if on_result is not None:
+                            on_result(other_key, results[other_key])
+                    raise
+                print(f"Job stage finished: {key}")
+                if on_result is not None:
+                    on_result(key, results[key])
+    return results
@@ -0,0 +1,102 @@
+"""
+Cost-based RQ queues.
+
+Jobs are routed by their estimated runtime (job_cost) into the queues of
+JOB_QUEUES ("small", "medium", "large"). WeightedWorker serves all of them:
+queues are picked by smooth weighted round-robin on JOB_QUEUE_WEIGHTS, so a
+large job never holds up every small one, and a queue whose oldest job has
+waited longer than QUEUE_STARVATION_SECONDS is served first.
+"""
+
+from datetime import datetime, timezone
+import redis
+from rq import Queue, Worker
+from rq.job import Job
+from .config import (
+    REDIS_URL,
+    JOB_QUEUES,
+    DEFAULT_JOB_QUEUE,
+    JOB_QUEUE_WEIGHTS,
+    QUEUE_STARVATION_SECONDS,
+)
+
+conn = redis.from_url(REDIS_URL)
+
+JOB_QUEUE_NAMES = [name for name, _ in JOB_QUEUES]
+# Jobs enqueued before the cost-based queues existed
+LEGACY_QUEUE_NAME = "default"
+
+
+def queue_name_for_cost(cost):
+    if not cost:
+        return DEFAULT_JOB_QUEUE
+    for name, max_runtime in JOB_QUEUES:
+        if max_runtime is None or cost["runtime_seconds"] <= max_runtime:
+            return name
+    return JOB_QUEUE_NAMES[-1]
+
+
+def get_job_queue(name, connection=None):
+    return Queue(name, connection=connection or conn)
+
+
+def all_job_queues(connection=None):
+    return [
+        get_job_queue(name, connection)
+        for name in JOB_QUEUE_NAMES + [LEGACY_QUEUE_NAME]
+    ]
+
+
+def oldest_job_wait_seconds(queue):
+    """How long the job at the head of `queue` has been waiting (0 if empty)."""
+    job_id = queue.connection.lindex(queue.key, 0)
+    if job_id is None:
+        return 0
+    try:
+        job = Job.fetch(job_id.decode(), connection=queue.connection)
+    except Exception:
+        return 0
+    if job.enqueued_at is None:
+        return 0
+    enqueued_at = job.enqueued_at
+    if enqueued_at.tzinfo is None:
+        enqueued_at = enqueued_at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - enqueued_at).total_seconds()
+
+
+class WeightedWorker(Worker):
+    """RQ worker dequeuing from several queues by weight, with starvation protection."""
+
+    def __init__(self, queues, *args, **kwargs):
+        super().__init__(queues, *args, **kwargs)
+        self._credits = {q.name: 0 for q in self.queues}
+
+    def _weight(self, queue):
+        return JOB_QUEUE_WEIGHTS.get(queue.name, 1)
+
+    def weighted_order(self):
+        starving = []
+        for queue in self.queues:
+            waited = oldest_job_wait_seconds(queue)
+            if waited >= QUEUE_STARVATION_SECONDS:
+                starving.append((waited, queue))
+        starving = [q for _, q in sorted(starving, key=lambda item: -item[0])]
+        rest = sorted(
+            (q for q in self.queues if q not in starving),
+            key=lambda q: -(self._credits[q.name] + self._weight(q)),
+        )
+        return starving + rest
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        self._ordered_queues = self.weighted_order()
+        return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+
+    def reorder_queues(self, reference_queue):
+        # Smooth weighted round-robin: every queue earns its weight, the one just
+        # served pays the total. Credits are bounded so idle queues don't bank them.
+        total = sum(self._weight(q) for q in self.queues)
+        for queue in self.queues:
+            credit = self._credits[queue.name] + self._weight(queue)
+            if queue.name == reference_queue.name:
+                credit -= total
+            self._credits[queue.name] = max(min(credit, total), -total)
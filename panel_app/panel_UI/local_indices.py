@@ -0,0 +1,223 @@
+"""
+Worker-local computation of climate indices with xclim, an alternative to one
+finch process per index (INDEX_ENGINE = "local").
+
+The indices of a job sharing downscaled outputs form a batch (LocalIndexBatches).
+Each output is opened once over OPeNDAP, chunked by blocks of grid rows
+holding the whole period (LOCAL_CHUNK_MB), and every index of the batch, at
+each resolution and threshold, is computed and written in a single dask pass.
+Wet-day percentile references (days_over_precip_thresh) come from the
+pr_percentile cache shared with the finch engine.
+
+Indices use the xclim indicators finch exposes under the same identifiers,
+with the parameters of setup_index_process_params. Each one is written as
+<output_name>.nc to a new directory under LOCAL_INDEX_OUTPUT_DIR, part of the
+WPS outputs area served at LOCAL_INDEX_OUTPUT_URL, so the result links are the
+usual THREDDS ones.
+"""
+
+import os
+import threading
+import uuid
+import xarray as xr
+from .config import LOCAL_CHUNK_MB, LOCAL_INDEX_OUTPUT_DIR, LOCAL_INDEX_OUTPUT_URL
+from .netcdf_io import open_dataset, write_datasets
+from .panel_helpers import (
+    find_opendap_url,
+    get_output_thredds_fileserver_location,
+    setup_index_process_params,
+)
+from .intermediates import release_pins
+from .pr_percentile import get_pr_percentile_file
+from .wps_wrappers import index_process_spec
+
+# Finch-only parameters, or parameters finch turns into xclim indexers
+INDEXER_PARAMS = ("month", "season")
+
+
+def _indicator(identifier):
+    # xclim is only needed by this engine
+    from xclim.core.indicator import registry
+
+    return registry[identifier.upper()].get_instance()
+
+
+def _input_names(indicator):
+    """Names of the indicator's data inputs, in the order finch takes them."""
+    return [
+        name
+        for name, param in indicator.parameters.items()
+        if getattr(param.kind, "name", "") in ("VARIABLE", "OPTIONAL_VARIABLE")
+    ]
+
+
+def _space_chunks(da):
+    """The whole period, and as many grid rows per chunk as fit LOCAL_CHUNK_MB."""
+    row_bytes = da.dtype.itemsize * da.size // da.sizes["lat"]
+    rows = max(int(LOCAL_CHUNK_MB * 2**20 // max(row_bytes, 1)), 1)
+    return {"time": -1, "lat": min(rows, da.sizes["lat"])}
+
+
+def _open_input(url):
+    ds = open_dataset(url)
+    name = next(iter(ds.data_vars))
+    da = ds[name]
+    return ds, da.chunk(_space_chunks(da))
+
+
+def _index_dataset(ix_params, spec, inputs, pr_per, source_attrs):
+    """Lazy output dataset of one index and its file name."""
+    indicator = _indicator(spec["identifier"])
+    params = setup_index_process_params(
+        spec["identifier"],
+        ix_params.get("resolution"),
+        spec["threshold"],
+        ix_params.get("region"),
+    )
+    output_name = params.pop("output_name")
+    kwargs = dict(zip(_input_names(indicator), inputs))
+    if pr_per is not None:
+        kwargs["pr_per"] = pr_per
+    for key, value in params.items():
+        if key in indicator.parameters or (
+            key in INDEXER_PARAMS and "indexer" in indicator.parameters
+        ):
+            kwargs[key] = value
+
+    out = indicator(**kwargs)
+    ds = xr.merge(out) if isinstance(out, tuple) else out.to_dataset()
+    ds.attrs = dict(source_attrs, **ds.attrs)
+    return ds, f"{output_name}.nc"
+
+
+def compute_indices(requests, downscaling_outputs):
+    """
+    Compute the indices {key: ix_params} from the downscaled outputs in one
+    pass and return {key: result line} as run_single_index does.
+    """
+    if not LOCAL_INDEX_OUTPUT_DIR:
+        raise ValueError("INDEX_ENGINE=local requires LOCAL_INDEX_OUTPUT_DIR.")
+
+    results = {}
+    specs = {}
+    for key, ix_params in requests.items():
+        spec = index_process_spec(ix_params)
+        urls = [find_opendap_url(v, downscaling_outputs) for v in spec["variables"]]
+        if not urls or any(url is None for url in urls):
+            results[key] = f"{ix_params['index_name']}: ❌ No input file"
+        else:
+            specs[key] = (spec, urls)
+    if not specs:
+        return results
+
+    # Percentile references first: they may be computed (pr_percentile), and
+    # are shared with the finch engine and across jobs. They stay pinned
+    # against eviction until the batch is written
+    percentiles = {}
+    pins = []
+    opened = {}
+    outputs = {}
+    try:
+        for key, (spec, urls) in list(specs.items()):
+            if spec["percentile"] is not None:
+                try:
+                    percentiles[key] = get_pr_percentile_file(
+                        urls[0], *spec["percentile"], pins
+                    )
+                except Exception as e:
+                    results[key] = f"{requests[key]['index_name']}: ❌ Error {str(e)}"
+                    del specs[key]
+
+        batch_id = uuid.uuid4().hex
+        out_dir = os.path.join(LOCAL_INDEX_OUTPUT_DIR, batch_id)
+        os.makedirs(out_dir, exist_ok=True)
+        # netcdf_lock is only held for each chunk read and write (netcdf_io)
+        for key, (spec, urls) in specs.items():
+            index_name = requests[key]["index_name"]
+            try:
+                for url in urls:
+                    if url not in opened:
+                        opened[url] = _open_input(url)
+                inputs = [opened[url][1] for url in urls]
+                pr_per = None
+                if key in percentiles:
+                    path = percentiles[key]
+                    if path not in opened:
+                        per_ds = open_dataset(path)
+                        opened[path] = (per_ds, per_ds["pr_per"])
+                    pr_per = opened[path][1]
+                outputs[key] = _index_dataset(
+                    requests[key], spec, inputs, pr_per, opened[urls[0]][0].attrs
+                )
+            except Exception as e:
+                results[key] = f"{index_name}: ❌ Error {str(e)}"
+
+        keys = list(outputs)
+        paths = [os.path.join(out_dir, outputs[key][1]) for key in keys]
+        try:
+            # One graph: every input chunk is read once for all the indices
+            write_datasets([outputs[key][0] for key in keys], paths)
+            failed = []
+        except Exception as e:
+            print(f"❗ Local index batch failed ({e}); writing indices one by one")
+            failed = keys
+        for key, path in zip(keys, paths):
+            index_name = requests[key]["index_name"]
+            if key in failed:
+                try:
+                    write_datasets([outputs[key][0]], [path])
+                except Exception as e:
+                    results[key] = f"{index_name}: ❌ Error {str(e)}"
+                    continue
+            output_url = f"{LOCAL_INDEX_OUTPUT_URL.rstrip('/')}/{batch_id}/{outputs[key][1]}"
+            results[key] = (
+                f"{index_name}: {get_output_thredds_fileserver_location(output_url)}"
+            )
+    finally:
+        for ds, _ in opened.values():
+            ds.close()
+        release_pins(pins)
+    return results
+
+
+class LocalIndexBatches:
+    """
+    Runs the index stages of a job graph with compute_indices, one batch per
+    group of indices sharing an input variable (directly or through other
+    indices of the group), so each downscaled output is read once. The deps of
+    the index nodes are widened to the inputs of their batch: the batch starts
+    once all of them are downscaled. The first stage of a batch to run
+    computes every index of the batch, the others pick up their results.
+    """
+
+    def __init__(self, nodes, completed=()):
+        self._nodes = nodes
+        batches = []
+        for key, node in nodes.items():
+            if node["kind"] != "index" or key in completed:
+                continue
+            deps, keys = set(node["deps"]), [key]
+            # Indices without inputs (reported as such) share a batch too
+            for batch in [b for b in batches if b[0] & deps or b[0] == deps]:
+                batches.remove(batch)
+                deps |= batch[0]
+                keys = batch[1] + keys
+            batches.append((deps, keys))
+        self._batch_of = {}
+        self._batches = {}
+        for batch, (deps, keys) in enumerate(batches):
+            self._batches[batch] = keys
+            for key in keys:
+                self._batch_of[key] = batch
+                nodes[key]["deps"] = sorted(deps)
+        self._locks = {batch: threading.Lock() for batch in self._batches}
+        self._results = {}
+
+    def run(self, node, dep_results):
+        batch = self._batch_of[node["key"]]
+        with self._locks[batch]:
+            if node["key"] not in self._results:
+                keys = [k for k in self._batches[batch] if k not in self._results]
+                requests = {k: self._nodes[k]["params"] for k in keys}
+                self._results.update(compute_indices(requests, dep_results))
+        return self._results[node["key"]]
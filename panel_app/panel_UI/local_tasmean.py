@@ -0,0 +1,83 @@
+"""
+Worker-local computation of daily mean temperature, an alternative to the
+finch `tg` process (TASMEAN_ENGINE = "local").
+
+The tasmax and tasmin OPeNDAP subsets are streamed in time chunks with
+xarray/dask, averaged and written to the intermediate store (intermediates.py),
+from which chickadee fetches the result by URL. The files are cached by input
+URLs, least recently used ones evicted beyond TASMEAN_CACHE_MB unless a job
+has them pinned (intermediates.pin).
+"""
+
+import os
+import hashlib
+import threading
+from .config import INTERMEDIATE_DIR, LOCAL_CHUNK_DAYS, TASMEAN_CACHE_MB
+from .intermediates import evict_lru, intermediate_url, path_lock, pin, require_store
+from .netcdf_io import open_dataset, write_datasets
+
+TASMEAN_DIR = os.path.join(INTERMEDIATE_DIR or "", "tasmean")
+
+
+def _open_subset(url):
+    return open_dataset(url, chunks={"time": LOCAL_CHUNK_DAYS}, decode_times=False)
+
+
+def _write_tasmean(tasmax_url, tasmin_url, path):
+    tasmax_ds = _open_subset(tasmax_url)
+    tasmin_ds = _open_subset(tasmin_url)
+    try:
+        tasmax = tasmax_ds["tasmax"]
+        tg = (tasmax + tasmin_ds["tasmin"]) / 2
+        tg = tg.rename("tg").astype(tasmax.dtype)
+        tg.attrs = {
+            "standard_name": "air_temperature",
+            "long_name": "Mean daily temperature",
+            "units": tasmax.attrs.get("units", "K"),
+            "cell_methods": "time: mean within days",
+        }
+        out = tg.to_dataset()
+        out.attrs = dict(tasmax_ds.attrs)
+        out.attrs["history"] = (
+            "tg = (tasmax + tasmin) / 2 computed by ODDS worker; "
+            + tasmax_ds.attrs.get("history", "")
+        ).strip("; ")
+        # netcdf_lock is only held for each chunk read and write
+        write_datasets([out], [path], [{"tg": {"zlib": True, "complevel": 4}}])
+    finally:
+        tasmax_ds.close()
+        tasmin_ds.close()
+
+
+def compute_tasmean(tasmax_url, tasmin_url, pins):
+    """
+    Write (tasmax + tasmin) / 2 as variable `tg` (the name finch uses, and the
+    gcm_varname passed to chickadee) and return the file's URL. The file is
+    pinned against eviction until the caller's release_pins(pins).
+    """
+    require_store("TASMEAN_ENGINE=local")
+
+    digest = hashlib.sha256(f"{tasmax_url}\n{tasmin_url}".encode()).hexdigest()[:16]
+    name = f"tasmean_{digest}.nc"
+    path = os.path.join(TASMEAN_DIR, name)
+    url = intermediate_url(path)
+    # Variables of a job needing the same tasmean wait for the first one
+    with path_lock(path):
+        os.makedirs(TASMEAN_DIR, exist_ok=True)
+        pins.append((path, pin(path)))
+        if os.path.exists(path):
+            # The modification time orders the LRU
+            os.utime(path)
+            return url
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            _write_tasmean(tasmax_url, tasmin_url, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    try:
+        evict_lru(TASMEAN_DIR, TASMEAN_CACHE_MB)
+    except OSError as e:
+        print(f"❗ Could not evict tasmean cache: {e}")
+    return url
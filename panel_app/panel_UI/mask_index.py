@@ -0,0 +1,194 @@
+"""
+Precomputed coverage masks for the observation domains.
+
+Each domain (see MASK_INDEX_DOMAINS in config.py) is read once from THREDDS and
+stored under MASK_INDEX_DIR as a bit-packed "has data" grid plus its lat/lon axes.
+Server processes memory-map those files, so checking a map click needs no
+network access.
+
+A missing or stale index is built in a background thread of the server (at
+startup, or on the first map click), one builder per domain across processes
+(file lock); until it is ready, clicks are checked against THREDDS directly.
+Build (or rebuild) the indices ahead of time with:
+
+    python -m panel_app.panel_UI.mask_index [domain ...]
+"""
+
+import fcntl
+import json
+import os
+import sys
+import threading
+import numpy as np
+from netCDF4 import Dataset
+from .config import MASK_INDEX_DIR, MASK_INDEX_DOMAINS
+from .coordinate_axis import CoordinateAxis, netcdf_lock
+
+# Rows of the source grid read per OPeNDAP request while building
+BUILD_BLOCK_ROWS = 256
+
+_loaded = {}
+_building = set()
+_building_lock = threading.Lock()
+
+
+def _index_paths(name):
+    base = os.path.join(MASK_INDEX_DIR, name)
+    return {
+        "mask": f"{base}_mask.npy",
+        "lat": f"{base}_lat.npy",
+        "lon": f"{base}_lon.npy",
+        "meta": f"{base}.json",
+    }
+
+
+def _missing_cells(var, block):
+    """Boolean array marking masked, NaN and fill/missing cells of `block`."""
+    missing = np.ma.getmaskarray(block).copy()
+    values = np.ma.getdata(block).astype("float64")
+    missing |= np.isnan(values)
+    for attr in ("_FillValue", "missing_value"):
+        if hasattr(var, attr):
+            for mv in np.atleast_1d(getattr(var, attr)):
+                try:
+                    missing |= values == float(mv)
+                except (TypeError, ValueError):
+                    pass
+    return missing
+
+
+def _index_current(name):
+    """Whether the index of `name` exists and was built from its current source."""
+    paths = _index_paths(name)
+    if not all(os.path.exists(path) for path in paths.values()):
+        return False
+    with open(paths["meta"]) as f:
+        meta = json.load(f)
+    return meta.get("url") == MASK_INDEX_DOMAINS[name][0]
+
+
+def build_mask_index(name, latvar="lat", lonvar="lon", time_index=0, force=True):
+    """
+    Read the coverage of domain `name` from THREDDS and persist it to disk.
+    Without `force`, an index another process built meanwhile is kept.
+    """
+    nc_url, varname = MASK_INDEX_DOMAINS[name]
+    paths = _index_paths(name)
+    os.makedirs(MASK_INDEX_DIR, exist_ok=True)
+
+    # One builder per domain across processes; the others wait for its index
+    with open(os.path.join(MASK_INDEX_DIR, f"{name}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if not force and _index_current(name):
+            return
+        print(f"Building mask index '{name}' from {nc_url}")
+
+        # netcdf_lock is held around each netCDF4 call only (the builds run on
+        # server threads next to map clicks and the other domain's build)
+        with netcdf_lock:
+            ds = Dataset(nc_url)
+        try:
+            with netcdf_lock:
+                lat = np.asarray(ds.variables[latvar][:], dtype="float64")
+                lon = np.asarray(ds.variables[lonvar][:], dtype="float64")
+                var = ds.variables[varname]
+                has_time = getattr(var, "ndim", 2) == 3
+            packed = np.zeros((lat.size, (lon.size + 7) // 8), dtype="uint8")
+            for start in range(0, lat.size, BUILD_BLOCK_ROWS):
+                stop = min(start + BUILD_BLOCK_ROWS, lat.size)
+                with netcdf_lock:
+                    block = (
+                        var[time_index, start:stop, :] if has_time else var[start:stop, :]
+                    )
+                    missing = _missing_cells(var, block)
+                packed[start:stop] = np.packbits(~missing, axis=1)
+        finally:
+            with netcdf_lock:
+                ds.close()
+
+        # Write to temporary names first so readers never see a partial index
+        for key, arr in (("mask", packed), ("lat", lat), ("lon", lon)):
+            tmp = f"{paths[key]}.{os.getpid()}.tmp.npy"
+            np.save(tmp, arr)
+            os.replace(tmp, paths[key])
+        tmp = f"{paths['meta']}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {"url": nc_url, "varname": varname, "shape": [lat.size, lon.size]}, f
+            )
+        os.replace(tmp, paths["meta"])
+    _loaded.pop(name, None)
+
+
+def _build_in_background(name):
+    with _building_lock:
+        if name in _building:
+            return
+        _building.add(name)
+
+    def build():
+        try:
+            build_mask_index(name, force=False)
+        except Exception as e:
+            print(f"❗ Could not build mask index '{name}': {e}")
+        finally:
+            with _building_lock:
+                _building.discard(name)
+
+    threading.Thread(target=build, name=f"mask-index-{name}", daemon=True).start()
+
+
+def start_mask_index_builds():
+    """Build the missing or stale indices in the background (server startup)."""
+    for name in MASK_INDEX_DOMAINS:
+        if not _index_current(name):
+            _build_in_background(name)
+
+
+def load_mask_index(name):
+    """
+    Return the memory-mapped index for domain `name`, or None while it is
+    missing or stale (a background build is then started).
+    """
+    index = _loaded.get(name)
+    if index is not None:
+        return index
+
+    if not _index_current(name):
+        _build_in_background(name)
+        return None
+
+    paths = _index_paths(name)
+    index = {
+        "mask": np.load(paths["mask"], mmap_mode="r"),
+        "lat": CoordinateAxis(np.load(paths["lat"], mmap_mode="r")),
+        "lon": CoordinateAxis(np.load(paths["lon"], mmap_mode="r")),
+    }
+    _loaded[name] = index
+    return index
+
+
+def point_in_mask_index(name, point):
+    """
+    Same answer as panel_helpers._point_in_mask for the domain's source file:
+    False outside the lat/lon bounds or when the nearest cell has no data.
+    None while the index is not ready.
+    """
+    index = load_mask_index(name)
+    if index is None:
+        return None
+    lat, lon = index["lat"], index["lon"]
+    plat, plon = float(point[0]), float(point[1])
+
+    if plat < lat[0] or plat > lat[-1] or plon < lon[0] or plon > lon[-1]:
+        return False
+
+    lat_index = lat.nearest(plat)
+    lon_index = lon.nearest(plon)
+    byte = index["mask"][lat_index, lon_index // 8]
+    return bool((byte >> (7 - lon_index % 8)) & 1)
+
+
+if __name__ == "__main__":
+    for domain in sys.argv[1:] or MASK_INDEX_DOMAINS:
+        build_mask_index(domain)
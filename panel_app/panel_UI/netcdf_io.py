@@ -0,0 +1,36 @@
+"""
+xarray reads and writes sharing coordinate_axis.netcdf_lock.
+
+netCDF4 is not thread-safe. Datasets opened and written here take
+netcdf_lock around each netCDF4 call only (opening a file, reading or writing
+one chunk), so dask computes between the calls on its own threads while the
+other stages of the worker keep using netCDF4.
+"""
+
+import xarray as xr
+from xarray.backends import NetCDF4DataStore
+from xarray.backends.common import ArrayWriter
+from .coordinate_axis import netcdf_lock
+
+
+def open_dataset(url, **kwargs):
+    return xr.open_dataset(url, engine="netcdf4", lock=netcdf_lock, **kwargs)
+
+
+def write_datasets(datasets, paths, encodings=None):
+    """
+    Write each dataset to its path. Lazy variables of all the datasets are
+    computed in one dask graph, so inputs they share are read once.
+    """
+    encodings = encodings or [None] * len(datasets)
+    writer = ArrayWriter()
+    stores = []
+    try:
+        for ds, path, encoding in zip(datasets, paths, encodings):
+            store = NetCDF4DataStore.open(path, mode="w", lock=netcdf_lock)
+            stores.append(store)
+            ds.dump_to_store(store, writer=writer, encoding=encoding)
+        writer.sync()
+    finally:
+        for store in stores:
+            store.close()
@@ -3,12 +3,13 @@ from netCDF4 import Dataset, date2num
 from datetime import date
 from datetime import datetime
 from time import sleep
-import requests
-import xml.etree.ElementTree as ET
 from ipywidgets import *
 from ipyleaflet import *
 from IPython import display as ipydisplay
 from .config import *
+from .mask_index import point_in_mask_index
+from .coordinate_axis import get_axis, get_index_range, netcdf_lock
+from .catalog_index import get_catalog_models, lookup_gcm_url
 
 
 def _point_in_mask(nc_url, varname, point, latvar="lat", lonvar="lon", time_index=0):
@@ -16,16 +17,17 @@ def _point_in_mask(nc_url, varname, point, latvar="lat", lonvar="lon", time_inde
     Check if (lat, lon) is within [lat, lon] bounds of nc_url and not masked/missing
     at the nearest grid cell for `varname`.
     """
-    with Dataset(nc_url) as ds:
-        lat = ds.variables[latvar][:]
-        lon = ds.variables[lonvar][:]
+    # A mask index may be built from THREDDS on another thread meanwhile
+    with netcdf_lock, Dataset(nc_url) as ds:
+        lat = get_axis(nc_url, latvar, ds)
+        lon = get_axis(nc_url, lonvar, ds)
         plat, plon = float(point[0]), float(point[1])
 
         if plat < lat[0] or plat > lat[-1] or plon < lon[0] or plon > lon[-1]:
             return False
 
-        lat_index = int(np.argmin(np.abs(lat - plat)))
-        lon_index = int(np.argmin(np.abs(lon - plon)))
+        lat_index = lat.nearest(plat)
+        lon_index = lon.nearest(plon)
 
         var = ds.variables[varname]
         cell = (
@@ -70,12 +72,20 @@ def _point_in_mask(nc_url, varname, point, latvar="lat", lonvar="lon", time_inde
         return True
 
 
+def _in_domain(name, point):
+    inside = point_in_mask_index(name, point)
+    if inside is None:
+        # Index still being built: check the cell on THREDDS
+        inside = _point_in_mask(*MASK_INDEX_DOMAINS[name], point)
+    return inside
+
+
 def in_bc(point):
-    return _point_in_mask(PRISM_URL, "pr", point)
+    return _in_domain("bc_prism", point)
 
 
 def in_canada(point):
-    return _point_in_mask(CANADA_MOSAIC_URL, "pr", point)
+    return _in_domain("canada_mosaic", point)
 
 
 def resolve_gcm_mask_url(state, gcm_var):
@@ -93,23 +103,29 @@ def resolve_gcm_mask_url(state, gcm_var):
         url = pcic_blend_url(gcm_var)
         return url, gcm_var
     # CMIP6:
-    tech_dir = "BCCAQ2" if internal_tech == "BCCAQv2" else "MBCn"
-    model_dir = model if internal_tech == "BCCAQv2" else f"{model}_10"
-    catalog = cmip6_catalog_url(tech_dir, internal_tech, model_dir)
-    r = requests.get(catalog)
-    r.raise_for_status()
-    root = ET.fromstring(r.content)
-    ns = {"thredds": "http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"}
-
-    for dataset in root.findall(".//thredds:dataset", ns):
-        name = dataset.get("name")
-        if name and (gcm_var in name) and (scenario in name):
-            url = cmip6_url(tech_dir, internal_tech, model_dir, name)
-            return url, gcm_var
-
-    raise LookupError(
-        f"No CMIP6 file for var={gcm_var}, scenario={scenario}, model={model}, tech={internal_tech}."
-    )
+    url = lookup_gcm_url(model, internal_tech, gcm_var, scenario)
+    return url, gcm_var
+
+
+def resolve_downscaling_inputs(ds_params):
+    """
+    Return (gcm_file, obs_file, gcm_var, obs_var) for one downscaling job.
+    tasmean is read from its tasmax file (tasmin is swapped in later).
+    """
+    clim_var = ds_params["clim_var"]
+    model = ds_params["model"]
+    gcm_var = "tasmax" if clim_var == "tasmean" else clim_var
+    obs_var = CLIM_VARS[clim_var]
+
+    if ds_params["dataset"].split(" ")[0] == "PCIC-Blend":
+        gcm_file = pcic_blend_url(gcm_var)
+    else:
+        # Locate the filename in THREDDS based on the parameter values
+        run = ds_params.get("canesm5_run") if model == "CanESM5" else None
+        gcm_file = lookup_gcm_url(
+            model, ds_params["technique"], gcm_var, ds_params["scenario"], run
+        )
+    return gcm_file, canada_mosaic_url(obs_var), gcm_var, obs_var
 
 
 def in_gcm_for_vars(point, state, selected_vars):
@@ -143,39 +159,15 @@ def get_subdomain(lat_min, lat_max, lon_min, lon_max, color, name):
 
 def get_models():
     """Get the list of available CMIP6 models."""
-    r = requests.get(bccaq2_catalog_url())
-    r.raise_for_status()
-    root = ET.fromstring(r.content)
-    ns = {"thredds": "http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"}
-
-    exclude = [
-        "AgroClimate",
-        "CMIP6_BCCAQv2",
-        "CWEC2020_Factors",
-        "Degree_Climatologies",
-        "Ensemble_Averages",
-        "nobackup",
-        "--",
-        "",
-    ]
-    models = []
-    for catalog_ref in root.findall(".//thredds:catalogRef", ns):
-        name = catalog_ref.get("{http://www.w3.org/1999/xlink}title")
-        if name and name not in exclude:
-            models.append(name)
-
-    if not models:
-        raise ValueError(f"No models found in THREDDS catalog: {bccaq2_catalog_url()}")
-
-    models.sort()
-    return models
-
-
-def get_time_range(dataset, downscaled_period):
+    return get_catalog_models()
+
+
+def get_time_range(time_meta, downscaled_period):
     """Get the indices of the start and end of the
-    selected downscaled period."""
-    calendar = dataset.variables["time"].calendar
-    units = dataset.variables["time"].units
+    selected downscaled period. `time_meta` holds the
+    time axis "units" and "calendar" (dataset_metadata.time_metadata)."""
+    calendar = time_meta["calendar"]
+    units = time_meta["units"]
     start, end = downscaled_period.split("-")
     start += "-01-01"
     end_date = "-12-30" if calendar == "360_day" else "-12-31"
@@ -191,12 +183,19 @@ def get_time_range(dataset, downscaled_period):
     return f"[{start_bound}:{end_bound}]"
 
 
-def get_index_range(arr, min_val, max_val):
-    """Compute the indices in an array that correspond to the array's values
-    closest to desired min/max values."""
-    min_index = np.argmin(np.abs(arr - min_val))
-    max_index = np.argmin(np.abs(arr - max_val))
-    return (min_index, max_index)
+def index_input_variables(variable, func_name):
+    """Downscaled variables an index is computed from, in finch input order."""
+    if variable != "multivar":
+        return [variable]
+    if func_name in {"prsn", "prlp"}:
+        # Snow/rain partitioning requires precipitation + mean temperature.
+        return ["pr", "tasmean"]
+    if func_name == "heat_wave_index":
+        # Heat wave days process uses tasmax + single threshold.
+        return ["tasmax"]
+    # Heat wave number/max length and the remaining multivariate temperature
+    # indices use tasmin + tasmax.
+    return ["tasmin", "tasmax"]
 
 
 def find_opendap_url(variable, outputs):
@@ -0,0 +1,153 @@
+"""
+Out-of-core computation of the wet-day precipitation percentile (the pr_per
+reference of days_over_precip_thresh).
+
+The pr series is processed in blocks of grid cells holding the whole period,
+one block in memory at a time, as large as PERCENTILE_MEMORY_MB allows: longer
+periods mean smaller blocks, not more memory. Each block is filled with a few
+OPeNDAP reads of consecutive days, at most LOCAL_CHUNK_MB each, holding
+netcdf_lock (netCDF4 is not thread-safe) for each read only. The percentile is
+exact, with the linear interpolation of numpy/xarray quantile.
+
+get_pr_percentile_file caches the results on disk by input URL, percentile
+and wet-day threshold, so the same reference at other resolutions or in later
+jobs is not computed again. The cache is an LRU bounded to
+PR_PERCENTILE_CACHE_MB; files in use are pinned (intermediates.pin).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import warnings
+import numpy as np
+import xarray as xr
+from .config import (
+    LOCAL_CHUNK_MB,
+    PERCENTILE_MEMORY_MB,
+    PR_PERCENTILE_CACHE_DIR,
+    PR_PERCENTILE_CACHE_MB,
+)
+from .coordinate_axis import netcdf_lock
+from .intermediates import evict_lru, path_lock, pin
+
+# Blocks are reduced in float64 (like xarray's quantile) and sorted in place;
+# the wet-day mask and the NaN count need about one extra byte per value each
+BLOCK_BYTES_PER_VALUE = 8 * 1.25
+
+
+def wet_day_quantile(block, q, wetday_thresh):
+    """
+    Quantile `q` over axis 0 of the values >= `wetday_thresh` in `block`
+    (NaN where a cell has none). `block` is overwritten.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        block[~(block >= wetday_thresh)] = np.nan
+    # NaNs sort last, so each cell's n wet days come first
+    block.sort(axis=0)
+    n = np.count_nonzero(~np.isnan(block), axis=0)
+    pos = q * np.maximum(n - 1, 0)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+    lower = np.take_along_axis(block, lo[np.newaxis], axis=0)[0]
+    upper = np.take_along_axis(block, hi[np.newaxis], axis=0)[0]
+    result = lower + (upper - lower) * (pos - lo)
+    result[n == 0] = np.nan
+    return result
+
+
+def _block_shape(pr):
+    """(rows, columns) of a block within the memory budget."""
+    ntime, nlat, nlon = (pr.sizes[d] for d in ("time", "lat", "lon"))
+    cells = int(PERCENTILE_MEMORY_MB * 2**20 // (ntime * BLOCK_BYTES_PER_VALUE))
+    if cells >= nlon:
+        return min(cells // nlon, nlat), nlon
+    return 1, max(cells, 1)
+
+
+def _read_block(pr, lat, lon, rows, cols):
+    """The float64 block of pr at (lat, lon), read LOCAL_CHUNK_MB at a time."""
+    shape = (
+        pr.sizes["time"],
+        min(rows, pr.sizes["lat"] - lat),
+        min(cols, pr.sizes["lon"] - lon),
+    )
+    block = np.empty(shape)
+    day_bytes = block.shape[1] * block.shape[2] * pr.dtype.itemsize
+    days = max(int(LOCAL_CHUNK_MB * 2**20 // day_bytes), 1)
+    for start in range(0, block.shape[0], days):
+        with netcdf_lock:
+            block[start : start + days] = pr[
+                start : start + days, lat : lat + rows, lon : lon + cols
+            ].values
+    return block
+
+
+def build_pr_percentile_file(pr_url, percentile, wetday_thresh, path):
+    """Write the `percentile` of wet days of pr at `pr_url` to `path` as pr_per."""
+    q = percentile / 100.0
+    with netcdf_lock:
+        ds = xr.open_dataset(pr_url)
+    try:
+        name = "pr" if "pr" in ds.data_vars else next(iter(ds.data_vars))
+        pr = ds[name].transpose("time", "lat", "lon")
+        rows, cols = _block_shape(pr)
+        result = np.full((pr.sizes["lat"], pr.sizes["lon"]), np.nan)
+        for lat in range(0, pr.sizes["lat"], rows):
+            for lon in range(0, pr.sizes["lon"], cols):
+                block = _read_block(pr, lat, lon, rows, cols)
+                result[lat : lat + rows, lon : lon + cols] = wet_day_quantile(
+                    block, q, wetday_thresh
+                )
+                # Freed before the next block is allocated
+                del block
+
+        pr_per = xr.DataArray(
+            result,
+            dims=("lat", "lon"),
+            coords={"lat": pr["lat"], "lon": pr["lon"]},
+            name="pr_per",
+            # Finch/xclim unit checks require units on percentile input.
+            attrs=dict(pr.attrs),
+        )
+        with netcdf_lock:
+            pr_per.to_dataset().to_netcdf(path)
+    finally:
+        ds.close()
+    return path
+
+
+def _cache_path(pr_url, percentile, wetday_thresh):
+    payload = json.dumps([pr_url, float(percentile), float(wetday_thresh)])
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+    return os.path.join(PR_PERCENTILE_CACHE_DIR, f"pr_per_{digest}.nc")
+
+
+def get_pr_percentile_file(pr_url, percentile, wetday_thresh, pins):
+    """
+    Path of the pr_per file for these inputs, computed on a cache miss. The
+    file is pinned against eviction until the caller's release_pins(pins).
+    """
+    path = _cache_path(pr_url, percentile, wetday_thresh)
+    # Stages of a job needing the same reference wait for the first one
+    with path_lock(path):
+        os.makedirs(PR_PERCENTILE_CACHE_DIR, exist_ok=True)
+        pins.append((path, pin(path)))
+        if os.path.exists(path):
+            # The modification time orders the LRU
+            os.utime(path)
+            print(f"Using cached pr percentile {path}")
+            return path
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            build_pr_percentile_file(pr_url, percentile, wetday_thresh, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    try:
+        evict_lru(PR_PERCENTILE_CACHE_DIR, PR_PERCENTILE_CACHE_MB)
+    except OSError as e:
+        print(f"❗ Could not evict pr percentile cache: {e}")
+    return path
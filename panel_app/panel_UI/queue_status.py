@@ -0,0 +1,124 @@
+"""
+Status and ETA of submitted ODDS jobs.
+
+Positions come from fair_share.get_queue_position (LPOS and list lengths, no
+job lists are downloaded). Waiting times are estimated from a rolling history
+of how long finished jobs of each queue took (record_job_duration, called by
+the worker), shared by the workers currently running.
+"""
+
+import json
+from datetime import datetime, timezone
+from statistics import median
+from time import time
+import redis
+from rq import Worker
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from .config import REDIS_URL, JOB_DURATION_HISTORY
+from .fair_share import get_queue_position
+
+conn = redis.from_url(REDIS_URL)
+
+
+def _durations_key(queue_name):
+    return f"odds:durations:{queue_name}"
+
+
+def record_job_duration(queue_name, seconds):
+    try:
+        conn.lpush(_durations_key(queue_name), json.dumps(seconds))
+        conn.ltrim(_durations_key(queue_name), 0, JOB_DURATION_HISTORY - 1)
+    except redis.RedisError as e:
+        print(f"❗ Could not record job duration: {e}")
+
+
+def typical_duration(queue_name):
+    """Median duration (seconds) of recent jobs of a queue, or None."""
+    samples = conn.lrange(_durations_key(queue_name), 0, -1)
+    if not samples:
+        return None
+    return median(json.loads(raw) for raw in samples)
+
+
+def expected_runtime(job):
+    """Estimated runtime (seconds) of a job once it starts."""
+    cost = job.meta.get("cost")
+    if cost:
+        return cost["runtime_seconds"]
+    return typical_duration(job.origin) or 0
+
+
+def get_job_status(job_id, connection=None):
+    """
+    {"state", "queue", "position", "eta_seconds"} for a job, where
+    eta_seconds is the estimated time until its results are ready.
+    """
+    connection = connection or conn
+    try:
+        job = Job.fetch(job_id, connection=connection)
+        # Jobs refused by a busy service continue as a rescheduled job
+        while job.meta.get("requeued_as"):
+            job = Job.fetch(job.meta["requeued_as"], connection=connection)
+    except NoSuchJobError:
+        return {"state": "unknown", "queue": None, "position": None, "eta_seconds": None}
+
+    status = job.get_status(refresh=False)
+    info = {"state": "waiting", "queue": job.origin, "position": None, "eta_seconds": None}
+    runtime = expected_runtime(job)
+
+    if status in (JobStatus.FINISHED, JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED):
+        info["state"] = status.value
+        return info
+    if status == JobStatus.SCHEDULED:
+        info["state"] = "scheduled"
+        if job.meta.get("scheduled_for"):
+            info["eta_seconds"] = max(job.meta["scheduled_for"] - time(), 0) + runtime
+        return info
+    if status == JobStatus.STARTED:
+        info["state"] = "running"
+        started_at = job.started_at
+        if started_at is not None:
+            if started_at.tzinfo is None:
+                started_at = started_at.replace(tzinfo=timezone.utc)
+            elapsed = (datetime.now(timezone.utc) - started_at).total_seconds()
+            info["eta_seconds"] = max(runtime - elapsed, 0)
+        return info
+
+    position = get_queue_position(job, job.origin, connection)
+    info["position"] = position
+    if position is not None:
+        per_job = typical_duration(job.origin) or runtime
+        workers = max(Worker.count(connection=connection), 1)
+        info["eta_seconds"] = (position - 1) * per_job / workers + runtime
+    return info
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "unknown"
+    minutes = max(round(seconds / 60), 1)
+    if minutes < 90:
+        return f"about {minutes} min"
+    return f"about {minutes / 60:.1f} h"
+
+
+def format_job_status(info):
+    if info["state"] == "waiting":
+        position = info["position"] or "?"
+        return (
+            f"Waiting in the {info['queue']} queue (position {position}); "
+            f"results expected in {format_eta(info['eta_seconds'])}."
+        )
+    if info["state"] == "scheduled":
+        return (
+            "Waiting for processing capacity to free up; "
+            f"results expected in {format_eta(info['eta_seconds'])}."
+        )
+    if info["state"] == "running":
+        return f"Running; results expected in {format_eta(info['eta_seconds'])}."
+    if info["state"] == "finished":
+        return "Finished. Check your email for the results."
+    if info["state"] == "unknown":
+        return "Job not found."
+    return f"Job {info['state']}."
@@ -0,0 +1,51 @@
+"""
+Redis cache of finished WPS outputs, keyed by the canonical inputs that
+produced them.
+
+Identical requests (same resolved input URLs, index ranges and process
+parameters) reuse the outputs of an earlier run while they are still on the
+server. Entries expire before the outputs are purged (OUTPUT_RETENTION_SECONDS).
+The cache is best-effort: Redis errors are logged and treated as misses.
+"""
+
+import hashlib
+import json
+from time import time
+import redis
+from .config import REDIS_URL, OUTPUT_RETENTION_SECONDS, RESULT_CACHE_MARGIN_SECONDS
+
+conn = redis.from_url(REDIS_URL)
+
+
+def canonical_key(kind, inputs):
+    """Stable hash of `inputs` (a JSON-serialisable dict) for stage `kind`."""
+    payload = json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=str)
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return f"{kind}:{digest}"
+
+
+def get_cached_result(key):
+    try:
+        raw = conn.get(f"odds:result:{key}")
+    except redis.RedisError as e:
+        print(f"❗ Result cache unavailable: {e}")
+        return None
+    if raw is None:
+        return None
+    return json.loads(raw)["result"]
+
+
+def store_result(key, result, created_at=None):
+    """Cache `result` until shortly before its outputs are purged."""
+    created_at = created_at or time()
+    ttl = int(OUTPUT_RETENTION_SECONDS - RESULT_CACHE_MARGIN_SECONDS - (time() - created_at))
+    if ttl <= 0:
+        return
+    try:
+        conn.set(
+            f"odds:result:{key}",
+            json.dumps({"result": result, "created_at": created_at}),
+            ex=ttl,
+        )
+    except redis.RedisError as e:
+        print(f"❗ Could not cache result {key}: {e}")
@@ -6,33 +6,49 @@ from .widgets import build_panel_continue_button, summary_markdown
 from .user_warnings import user_warn, get_user_warning_pane
 from .email_results import send_summary_email
 from .step1_downscale import update_state_from_controls
-from .tasks import process_odds_job
-from .config import INDEX_FUNCTIONS_STRUCTURE, PARAMS_TO_WATCH
-from rq import Queue
+from .tasks import continue_job, process_odds_job
+from .panel_helpers import index_input_variables
+from .job_cost import estimate_job_cost, format_cost, job_timeout
+from .config import (
+    INDEX_FUNCTIONS_STRUCTURE,
+    PARAMS_TO_WATCH,
+    MAX_JOB_FETCH_GB,
+    ABANDONED_MAX_REQUEUES,
+)
+from .job_queues import queue_name_for_cost
+from .fair_share import job_finished, submission_key, submit_job_once
+from .queue_status import format_eta, format_job_status, get_job_status
+from rq.exceptions import AbandonedJobError
 from rq.job import Job
-import redis
 import pprint
 
-# Connect to Redis
-redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-conn = redis.from_url(redis_url)
-q = Queue(connection=conn)
-
-QUEUE_NOTE = (
-    "\n\n Processing time depends on the queue. "
-    "Simple jobs may finish quickly, but if many large jobs are ahead of you "
-    "it could take a few hours. You’ll receive an email when your results are ready."
-)
+QUEUE_NOTES = {
+    "small": (
+        "\n\n Your job is in the queue for small jobs. "
+        "Small jobs usually start within minutes. "
+        "You’ll receive an email when your results are ready."
+    ),
+    "medium": (
+        "\n\n Your job is in the queue for medium-sized jobs. "
+        "Processing time depends on the queue and it could take a few hours. "
+        "You’ll receive an email when your results are ready."
+    ),
+    "large": (
+        "\n\n Your job is in the queue for large jobs. "
+        "Large jobs share the workers with smaller ones, so it may take "
+        "several hours. You’ll receive an email when your results are ready."
+    ),
+}
 
 TEAM_ALERTS_EMAIL = os.environ.get("SMTP_FROM")
 
 
-def get_queue_position(job, queue):
-    job_ids = queue.job_ids
-    try:
-        return job_ids.index(job.id) + 1
-    except ValueError:
-        return None
+def _index_func_name(idx):
+    return next(
+        func
+        for name, func in INDEX_FUNCTIONS_STRUCTURE[idx["variable"]]
+        if name == idx["index_name"]
+    )
 
 
 def _format_failure_trace(exc_type, exc_value, exc_traceback):
@@ -46,6 +62,17 @@ def _format_failure_trace(exc_type, exc_value, exc_traceback):
 
 
 def notify_on_failure(job, connection, exc_type, exc_value, exc_traceback):
+    # The user's next pending job can start
+    job_finished(job)
+
+    # A worker died (crash, redeploy): restart the job instead of failing it.
+    # Its finished stages and running WPS executions are picked up again.
+    attempt = job.meta.get("abandoned_attempt", 0)
+    if exc_type is AbandonedJobError and attempt < ABANDONED_MAX_REQUEUES:
+        new_job = continue_job(job, abandoned_attempt=attempt + 1)
+        print(f"Job {job.id} was abandoned; restarted as {new_job.id}")
+        return
+
     subject = f"On-demand downscaling Job Failure: {job.id}"
     user_email = job.meta.get("user_email")
     formatted_args = ""
@@ -110,6 +137,24 @@ def step4_summary_view():
 
     state.param.watch(enable_launch, PARAMS_TO_WATCH)
 
+    # Status of the jobs launched from this session, refreshed on demand
+    submitted_job_ids = []
+    job_status_md = pn.pane.Markdown("", visible=False)
+    refresh_btn = pn.widgets.Button(name="Refresh job status", visible=False)
+
+    def show_job_status(*events):
+        lines = []
+        for job_id in submitted_job_ids:
+            try:
+                status_text = format_job_status(get_job_status(job_id))
+            except Exception as e:
+                status_text = f"Status unavailable ({e})"
+            lines.append(f"- **{job_id}**: {status_text}")
+        job_status_md.object = "\n".join(lines)
+        job_status_md.visible = refresh_btn.visible = bool(lines)
+
+    refresh_btn.on_click(show_job_status)
+
     def on_launch(event):
         launch_btn.disabled = True
         if not services_available():
@@ -130,18 +175,9 @@ def step4_summary_view():
             for idx in state.indices_selected:
                 var = idx["variable"]
                 print(f"Adding index var: {var}")
-                if var == "multivar":
-                    index_name = idx.get("index_name")
-                    if index_name in {"Snowfall", "Rainfall"}:
-                        variables_to_downscale.update({"pr", "tasmean"})
-                    elif index_name == "Heat Wave Days":
-                        variables_to_downscale.add("tasmax")
-                    elif index_name in {"Heat Wave Number", "Heat Wave Maximum Length"}:
-                        variables_to_downscale.update({"tasmin", "tasmax"})
-                    else:
-                        variables_to_downscale.update({"tasmin", "tasmax"})
-                else:
-                    variables_to_downscale.add(var)
+                variables_to_downscale.update(
+                    index_input_variables(var, _index_func_name(idx))
+                )
         else:
             # Downscale or both: use all selected variables
             variables_to_downscale = set(state.selected_variables)
@@ -166,14 +202,9 @@ def step4_summary_view():
 
         index_jobs = []
         for idx in state.indices_selected:
-            func_name = next(
-                func
-                for name, func in INDEX_FUNCTIONS_STRUCTURE[idx["variable"]]
-                if name == idx["index_name"]
-            )
             ix_params = {
                 "index_name": idx["index_name"],
-                "func_name": func_name,
+                "func_name": _index_func_name(idx),
                 "variable": idx["variable"],
                 "resolution": idx.get("resolution"),
                 "threshold": idx.get("threshold"),
@@ -188,23 +219,57 @@ def step4_summary_view():
             "user_email": user_email,
         }
 
-        job = q.enqueue(
+        try:
+            cost = estimate_job_cost(job_params)
+        except Exception as e:
+            # The worker falls back to its defaults for jobs without an estimate
+            print(f"❗ Could not estimate job cost: {e}")
+            cost = None
+        if cost and MAX_JOB_FETCH_GB and cost["fetch_gb"] > MAX_JOB_FETCH_GB:
+            user_warn(
+                f"This job would fetch about {cost['fetch_gb']:.1f} GB, more than the "
+                f"{MAX_JOB_FETCH_GB:g} GB limit. Select a shorter period or fewer variables.",
+                "danger",
+            )
+            launch_btn.disabled = False
+            return
+        job_params["cost"] = cost
+
+        queue_name = queue_name_for_cost(cost)
+        # Jobs start in per-user round-robin order (fair_share.py). Reloads and
+        # other tabs relaunching the same job get the job already submitted.
+        job, created = submit_job_once(
+            submission_key(user_email, job_params),
+            queue_name,
             "panel_app.panel_UI.tasks.process_odds_job",
+            (user_email, job_params),
             user_email,
-            job_params,
-            job_timeout=60 * 60 * 6,
+            meta={"cost": cost},
+            timeout=job_timeout(cost) if cost else 60 * 60 * 6,
             result_ttl=60 * 60 * 24 * 7,
             on_failure="panel_app.panel_UI.step4_summary.notify_on_failure",
         )
-        job.meta["user_email"] = user_email
-        job.save()
-        pos = get_queue_position(job, q)
+        if not created:
+            user_warn(
+                f"This job is already queued or running (Job ID: {job.get_id()}). "
+                "No new job was submitted; you’ll receive an email when its results are ready.",
+                "info",
+            )
+            if job.id not in submitted_job_ids:
+                submitted_job_ids.append(job.id)
+            show_job_status()
+            return
+        job_status = get_job_status(job.id)
+        pos = job_status["position"]
+        cost_note = f"\n\n{format_cost(cost)}." if cost else ""
 
         summary = summary_markdown(state)
         extra_info = f"\n\nJob ID: {job.get_id()}"
         if pos:
             extra_info += f"\nQueue position at submission: {pos}"
-        extra_info += QUEUE_NOTE
+        extra_info += f"\nEstimated time until results: {format_eta(job_status['eta_seconds'])}"
+        extra_info += cost_note
+        extra_info += QUEUE_NOTES[queue_name]
         try:
             send_summary_email(
                 user_email,
@@ -217,10 +282,12 @@ def step4_summary_view():
 
         user_warn(
             f"Job submitted! Job ID: {job.get_id()} "
-            f"(queue position: {pos}).\n\n"
-            f"{QUEUE_NOTE}",
+            f"(queue: {queue_name}, position: {pos}).{cost_note}\n\n"
+            f"{QUEUE_NOTES[queue_name]}",
             "info",
         )
+        submitted_job_ids.append(job.id)
+        show_job_status()
 
     def on_prev(event):
         if state.output_intent == "downscale":
@@ -235,6 +302,8 @@ def step4_summary_view():
         launch_blocked_alert,
         pn.Row(back_btn, launch_btn),
         get_user_warning_pane(),
+        job_status_md,
+        refresh_btn,
         width=1200,
         sizing_mode="fixed",
     )
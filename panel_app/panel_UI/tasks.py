@@ -1,28 +1,115 @@
+from functools import partial
+from time import time
+from rq import get_current_job
+from .config import (
+    DOWNSCALE_CONCURRENCY,
+    INDEX_CONCURRENCY,
+    BUSY_MAX_REQUEUES,
+    INDEX_ENGINE,
+)
+from .job_graph import build_job_graph, run_job_graph
 from .wps_wrappers import run_single_downscaling, run_single_index
+from .local_indices import LocalIndexBatches
 from .email_results import send_summary_email
+from .fair_share import job_finished, submit_job
+from .queue_status import record_job_duration
+from .wps_admission import ServiceBusy, busy_backoff
+from .job_checkpoints import checkpoint_id, load_stages, save_stage
+
+
+def run_job_stage(node, dep_results, local_indices=None):
+    if node["kind"] == "downscale":
+        return run_single_downscaling(node["params"], node["cost"])
+    print("\nDEBUG: Index job:", node["params"])
+    if local_indices is not None:
+        return local_indices.run(node, dep_results)
+    return run_single_index(node["params"], dep_results, node["cost"])
+
+
+def continue_job(job, delay=0, **meta):
+    """
+    Start a new run of `job` after `delay` seconds that resumes from its
+    checkpoint, and point the old job at it. The new run waits its turn in the
+    user's fair-share list like a new submission. Returns the new job.
+    """
+    new_job = submit_job(
+        job.origin,
+        job.func_name,
+        job.args,
+        job.meta.get("user_email"),
+        meta=dict(
+            job.meta,
+            requeued_from=job.id,
+            checkpoint_id=checkpoint_id(job),
+            scheduled_for=time() + delay,
+            **meta,
+        ),
+        connection=job.connection,
+        delay=delay,
+        timeout=job.timeout,
+        result_ttl=job.result_ttl,
+        on_failure=job.failure_callback,
+    )
+    job.meta["requeued_as"] = new_job.id
+    job.save_meta()
+    return new_job
+
+
+def requeue_busy_job(job, error):
+    """Run `job` again after a jittered backoff, or fail it after too many tries."""
+    attempt = job.meta.get("busy_attempt", 0)
+    if attempt >= BUSY_MAX_REQUEUES:
+        raise error
+    delay = busy_backoff(attempt)
+    new_job = continue_job(job, delay, busy_attempt=attempt + 1)
+    print(f"Services busy ({error}); requeued as {new_job.id} in {delay:.0f}s")
+    return f"Requeued as {new_job.id}"
 
 
 def process_odds_job(user_email, job_params):
     output_intent = job_params.get("output_intent", "downscale")  # default fallback
     print(f"user_email: {user_email}")
     print(f"params: {job_params}")
+    started = time()
 
-    downscale_results = []
-    index_results = []
+    job = get_current_job()
+    checkpoint = checkpoint_id(job) if job is not None else None
+    completed = load_stages(checkpoint) if checkpoint else {}
+    if completed:
+        print(f"Resuming from checkpoint {checkpoint}: {sorted(completed)}")
 
-    for ds_params in job_params.get("downscale_jobs", []):
-        output = run_single_downscaling(ds_params)
-        downscale_results.append(output)
+    def on_result(key, result):
+        # Failed indices are reported as "<name>: ❌ Error ..." by run_single_index;
+        # leave them out so a retry runs them again
+        if checkpoint and not (isinstance(result, str) and "❌ Error" in result):
+            save_stage(checkpoint, key, result)
+
+    # Indices start as soon as the variables they need are downscaled
+    nodes = build_job_graph(job_params)
+    local_indices = (
+        LocalIndexBatches(nodes, completed) if INDEX_ENGINE == "local" else None
+    )
+    try:
+        results = run_job_graph(
+            nodes,
+            partial(run_job_stage, local_indices=local_indices),
+            {"downscale": DOWNSCALE_CONCURRENCY, "index": INDEX_CONCURRENCY},
+            completed=completed,
+            on_result=on_result,
+        )
+    except ServiceBusy as e:
+        if job is None:
+            raise
+        result = requeue_busy_job(job, e)
+        job_finished(job)
+        return result
+    downscale_results = [
+        results[key] for key, node in nodes.items() if node["kind"] == "downscale"
+    ]
+    index_results = [
+        results[key] for key, node in nodes.items() if node["kind"] == "index"
+    ]
 
-    # Only run indices if needed
-    if output_intent in ("indices", "both"):
-        for ix_params in job_params.get("index_jobs", []):
-            print("\nDEBUG: Downscale results:")
-            for ds in downscale_results:
-                print(ds)
-            print("\nDEBUG: Index job:", ix_params)
-            output = run_single_index(ix_params, downscale_results)
-            index_results.append(output)
     email_lines = []
     if output_intent in ("downscale", "both"):
         email_lines.append("Downscaling outputs:")
@@ -41,4 +128,10 @@ def process_odds_job(user_email, job_params):
         "ODDS Results",
         email_body,
     )
+
+    # Feeds the ETAs shown to users waiting in the same queue
+    if job is not None:
+        record_job_duration(job.origin, time() - started)
+        # The user's next pending job can start
+        job_finished(job)
     return "Done"
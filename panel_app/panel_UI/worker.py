@@ -1,16 +1,27 @@
 import os
-import sys
 import redis
-from rq import Worker, Queue
-
-sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from panel_app.panel_UI.tasks import process_odds_job
+from panel_app.panel_UI.job_queues import all_job_queues
+from panel_app.panel_UI.fair_share import FairShareWorker
+from panel_app.panel_UI.async_worker import run_async_worker
+from panel_app.panel_UI.config import WORKER_MODE
+from panel_app.panel_UI.coalesce import resume_orphaned_executions
+from panel_app.panel_UI.wps_wrappers import COLLECTORS
 
 
 redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 conn = redis.from_url(redis_url)
 
 if __name__ == "__main__":
-    q = Queue(connection=conn)
-    worker = Worker([q])
-    worker.work()
+    # Keep polling WPS executions left behind by a worker that died
+    resumed = resume_orphaned_executions(COLLECTORS)
+    print(f"Resumed {resumed} orphaned WPS executions")
+    # small / medium / large by estimated cost, plus the legacy default queue;
+    # the queues are topped up from the per-user fair-share lists
+    queues = all_job_queues(conn)
+    # The scheduler still enqueues jobs scheduled directly on the RQ queues
+    if WORKER_MODE == "async":
+        # Several jobs per process, one thread each, supervised from an event loop
+        run_async_worker(queues, conn)
+    else:
+        worker = FairShareWorker(queues)
+        worker.work(with_scheduler=True)
@@ -0,0 +1,228 @@
+"""
+Supervisor scaling the number of worker processes with the job backlog.
+
+Every AUTOSCALE_INTERVAL_SECONDS the supervisor reads from Redis the jobs
+waiting (fair-share pending lists and RQ queues), their estimated runtime, the
+jobs running and our in-flight WPS executions, and starts or stops worker
+processes to stay between AUTOSCALE_MIN_WORKERS and AUTOSCALE_MAX_WORKERS:
+
+- running jobs keep their workers;
+- waiting jobs get extra workers, one job slot per AUTOSCALE_BACKLOG_SECONDS
+  of estimated runtime (at least one while anything waits);
+- no workers are added while chickadee or finch is full or marked busy,
+  since they would only wait for a slot.
+
+Workers are stopped with SIGTERM (idle ones first), which makes RQ and the
+async worker finish their running jobs before exiting, and only after fewer
+workers were needed for AUTOSCALE_SCALE_DOWN_DELAY_SECONDS. Stopping the
+supervisor drains all of its workers the same way.
+
+    python -m panel_app.panel_UI.worker_autoscaler
+"""
+
+import math
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+from time import monotonic, sleep
+import redis
+from rq import Worker
+from rq.worker import WorkerStatus
+from rq.job import Job, JobStatus
+from rq.registry import StartedJobRegistry
+from .config import (
+    REDIS_URL,
+    CHICKADEE_CAPACITY,
+    FINCH_CAPACITY,
+    WORKER_MODE,
+    ASYNC_WORKER_JOBS,
+    AUTOSCALE_MIN_WORKERS,
+    AUTOSCALE_MAX_WORKERS,
+    AUTOSCALE_BACKLOG_SECONDS,
+    AUTOSCALE_INTERVAL_SECONDS,
+    AUTOSCALE_SCALE_DOWN_DELAY_SECONDS,
+    AUTOSCALE_WORKER_COMMAND,
+)
+from .fair_share import pending_job_ids
+from .job_queues import all_job_queues
+from .queue_status import expected_runtime
+from .wps_admission import inflight_count, is_marked_busy
+
+conn = redis.from_url(REDIS_URL)
+
+# Services whose in-flight executions we cap across workers
+SERVICE_CAPACITIES = {"chickadee": CHICKADEE_CAPACITY, "finch": FINCH_CAPACITY}
+
+
+def jobs_per_worker():
+    return ASYNC_WORKER_JOBS if WORKER_MODE == "async" else 1
+
+
+def collect_backlog(connection=None):
+    """
+    {"waiting_jobs", "backlog_seconds", "running_jobs", "inflight",
+    "saturated"} read from Redis.
+    """
+    connection = connection or conn
+    queues = all_job_queues(connection)
+    waiting_ids = pending_job_ids(connection)
+    started_ids = []
+    for queue in queues:
+        waiting_ids += queue.get_job_ids()
+        started_ids += StartedJobRegistry(queue=queue).get_job_ids()
+
+    waiting = [
+        job
+        for job in Job.fetch_many(list(dict.fromkeys(waiting_ids)), connection=connection)
+        if job is not None
+    ]
+    # The started registry is only cleaned periodically
+    running = [
+        job
+        for job in Job.fetch_many(list(dict.fromkeys(started_ids)), connection=connection)
+        if job is not None and job.get_status(refresh=False) == JobStatus.STARTED
+    ]
+    inflight = {service: inflight_count(service) for service in SERVICE_CAPACITIES}
+    saturated = [
+        service
+        for service, capacity in SERVICE_CAPACITIES.items()
+        if inflight[service] >= capacity or is_marked_busy(service)
+    ]
+    return {
+        "waiting_jobs": len(waiting),
+        "backlog_seconds": sum(expected_runtime(job) for job in waiting),
+        "running_jobs": len(running),
+        "inflight": inflight,
+        "saturated": saturated,
+    }
+
+
+def desired_workers(backlog, current):
+    """Number of worker processes wanted for `backlog` with `current` running."""
+    per_worker = jobs_per_worker()
+    busy = math.ceil(backlog["running_jobs"] / per_worker)
+    extra = 0
+    if backlog["waiting_jobs"]:
+        slots = max(math.ceil(backlog["backlog_seconds"] / AUTOSCALE_BACKLOG_SECONDS), 1)
+        extra = math.ceil(min(slots, backlog["waiting_jobs"]) / per_worker)
+    wanted = busy + extra
+    if backlog["saturated"]:
+        # New workers would only wait for a WPS slot
+        wanted = min(wanted, max(current, busy))
+    return min(max(wanted, AUTOSCALE_MIN_WORKERS), AUTOSCALE_MAX_WORKERS)
+
+
+class WorkerAutoscaler:
+    """Starts and drains worker processes running `command`."""
+
+    def __init__(self, command=None, connection=None):
+        if command is None:
+            command = (
+                shlex.split(AUTOSCALE_WORKER_COMMAND)
+                if AUTOSCALE_WORKER_COMMAND
+                else [sys.executable, "-m", "panel_app.panel_UI.worker"]
+            )
+        self.command = command
+        self.connection = connection or conn
+        self.workers = []
+        self.draining = []
+        self._low_since = None
+        self._stop = threading.Event()
+
+    def _reap(self):
+        for proc in list(self.workers) + list(self.draining):
+            if proc.poll() is None:
+                continue
+            if proc in self.workers:
+                print(f"❗ Worker process {proc.pid} exited with code {proc.returncode}")
+                self.workers.remove(proc)
+            else:
+                print(f"Worker process {proc.pid} drained")
+                self.draining.remove(proc)
+
+    def _start_worker(self):
+        # Own session, so a Ctrl+C on the supervisor doesn't reach the workers
+        # before the supervisor drains them
+        proc = subprocess.Popen(self.command, start_new_session=True)
+        self.workers.append(proc)
+        print(f"Started worker process {proc.pid}")
+
+    def _busy_slots(self):
+        """{pid: busy job slots} of our worker processes, from their RQ records."""
+        hostname = socket.gethostname()
+        pids = {proc.pid for proc in self.workers}
+        busy = {pid: 0 for pid in pids}
+        try:
+            for worker in Worker.all(connection=self.connection):
+                if worker.hostname == hostname and worker.pid in pids:
+                    busy[worker.pid] += worker.get_state() == WorkerStatus.BUSY
+        except redis.RedisError as e:
+            print(f"❗ Could not read worker states: {e}")
+        return busy
+
+    def _drain(self, count):
+        busy = self._busy_slots()
+        # Idle workers first, then the ones with the fewest running jobs
+        for proc in sorted(self.workers, key=lambda p: busy.get(p.pid, 0))[:count]:
+            print(f"Draining worker process {proc.pid} ({busy.get(proc.pid, 0)} jobs running)")
+            proc.send_signal(signal.SIGTERM)
+            self.workers.remove(proc)
+            self.draining.append(proc)
+
+    def scale(self):
+        self._reap()
+        current = len(self.workers)
+        try:
+            backlog = collect_backlog(self.connection)
+        except redis.RedisError as e:
+            print(f"❗ Autoscaler could not read the backlog: {e}")
+            wanted = min(max(current, AUTOSCALE_MIN_WORKERS), AUTOSCALE_MAX_WORKERS)
+        else:
+            wanted = desired_workers(backlog, current)
+            print(
+                f"Autoscaler: {backlog['waiting_jobs']} jobs waiting "
+                f"(~{backlog['backlog_seconds'] / 60:.0f} min), "
+                f"{backlog['running_jobs']} running, in flight {backlog['inflight']}, "
+                f"workers {current} -> {wanted}"
+            )
+
+        if wanted > current:
+            self._low_since = None
+            for _ in range(wanted - current):
+                self._start_worker()
+        elif wanted < current:
+            self._low_since = self._low_since or monotonic()
+            if monotonic() - self._low_since >= AUTOSCALE_SCALE_DOWN_DELAY_SECONDS:
+                self._drain(current - wanted)
+                self._low_since = None
+        else:
+            self._low_since = None
+
+    def request_stop(self, signum, frame):
+        if self._stop.is_set():
+            # Second request: let the workers stop their jobs too
+            for proc in self.workers + self.draining:
+                proc.send_signal(signal.SIGTERM)
+            return
+        print("Autoscaler stopping: draining all workers")
+        self._stop.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        while not self._stop.is_set():
+            self.scale()
+            self._stop.wait(AUTOSCALE_INTERVAL_SECONDS)
+
+        self._drain(len(self.workers))
+        while self.draining:
+            self._reap()
+            sleep(1)
+        print("Autoscaler stopped")
+
+
+if __name__ == "__main__":
+    WorkerAutoscaler().run()
@@ -0,0 +1,181 @@
+"""
+Admission control for WPS services that refuse work when their queue is full.
+
+Every execution we submit to a throttled service holds a slot in a Redis
+sorted set shared by all workers, so we never have more than the service's
+capacity in flight. A slot is a lease that a thread of the holding process
+renews for as long as the execution runs, so the slots of a worker that died
+are freed after WPS_SLOT_LEASE_SECONDS. Each worker process also holds at most
+WPS_PROCESS_LIMITS[service] executions of a service at once, which matters in
+the async worker where several jobs share a process. When the service still
+answers ServerBusy, the service is marked busy for a backoff period (no worker
+submits to it meanwhile) and ServiceBusy is raised so the job can be requeued
+instead of failed.
+"""
+
+import random
+import threading
+import uuid
+from time import sleep, time
+import redis
+from .config import (
+    INFLIGHT_CHECK_SECONDS,
+    WPS_SLOT_LEASE_SECONDS,
+    WPS_SLOT_WAIT_SECONDS,
+    BUSY_BACKOFF_BASE_SECONDS,
+    BUSY_BACKOFF_MAX_SECONDS,
+    WPS_PROCESS_LIMITS,
+)
+from .result_cache import conn
+
+_process_slots = {
+    service: threading.BoundedSemaphore(limit)
+    for service, limit in WPS_PROCESS_LIMITS.items()
+}
+
+
+# Shared slots held by this process, {token: service}, renewed by _renew_slots
+_held_slots = {}
+_held_lock = threading.Lock()
+_renewer = None
+
+
+class ServiceBusy(Exception):
+    """A WPS service cannot take more executions right now."""
+
+
+def is_server_busy(error):
+    message = str(error)
+    return (
+        "ServerBusy" in message
+        and "Maximum number of processes in queue reached" in message
+    )
+
+
+def busy_backoff(attempt):
+    """Jittered exponential backoff (seconds) before retry number `attempt`."""
+    delay = min(BUSY_BACKOFF_BASE_SECONDS * 2**attempt, BUSY_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def _slots_key(service):
+    return f"odds:wps:{service}:slots"
+
+
+def _busy_key(service):
+    return f"odds:wps:{service}:busy"
+
+
+def mark_busy(service, seconds):
+    """Hold off all submissions to `service` for `seconds`."""
+    try:
+        conn.set(_busy_key(service), 1, ex=max(int(seconds), 1))
+    except redis.RedisError as e:
+        print(f"❗ Could not mark {service} busy: {e}")
+
+
+def is_marked_busy(service):
+    return bool(conn.exists(_busy_key(service)))
+
+
+def inflight_count(service):
+    now = time()
+    conn.zremrangebyscore(_slots_key(service), 0, now)
+    return conn.zcard(_slots_key(service))
+
+
+def _renew_slots():
+    while True:
+        sleep(WPS_SLOT_LEASE_SECONDS / 3)
+        with _held_lock:
+            held = list(_held_slots.items())
+        if not held:
+            continue
+        try:
+            pipe = conn.pipeline(transaction=False)
+            for token, service in held:
+                # Only slots still recorded: an expired one may have been taken
+                pipe.zadd(_slots_key(service), {token: time() + WPS_SLOT_LEASE_SECONDS}, xx=True)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"❗ Could not renew WPS slot leases: {e}")
+
+
+def _hold(service, token):
+    global _renewer
+    with _held_lock:
+        _held_slots[token] = service
+        if _renewer is None or not _renewer.is_alive():
+            _renewer = threading.Thread(
+                target=_renew_slots, name="wps-slot-lease", daemon=True
+            )
+            _renewer.start()
+
+
+def _acquire_shared_slot(service, capacity, deadline):
+    token = uuid.uuid4().hex
+    while True:
+        try:
+            lock = conn.lock(
+                f"{_slots_key(service)}:lock",
+                timeout=10,
+                blocking_timeout=min(max(deadline - time(), 0.1), 10),
+            )
+            # Not getting the lock in time (many workers waiting) is contention,
+            # not an outage: keep trying until the deadline
+            if lock.acquire():
+                try:
+                    if not conn.exists(_busy_key(service)) and inflight_count(service) < capacity:
+                        conn.zadd(_slots_key(service), {token: time() + WPS_SLOT_LEASE_SECONDS})
+                        _hold(service, token)
+                        return token
+                finally:
+                    try:
+                        lock.release()
+                    except redis.exceptions.LockError:
+                        # Expired meanwhile; the slot is recorded either way
+                        pass
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            # Without Redis, submit unthrottled; ServerBusy still requeues the job
+            print(f"❗ {service} admission control unavailable: {e}")
+            return None
+        except redis.RedisError as e:
+            print(f"❗ {service} admission control error, retrying: {e}")
+        if time() >= deadline:
+            raise ServiceBusy(f"No {service} capacity for {WPS_SLOT_WAIT_SECONDS}s")
+        sleep(INFLIGHT_CHECK_SECONDS)
+
+
+def acquire_slot(service, capacity=None):
+    """
+    Wait for one of this process's slots of `service` and, given a `capacity`,
+    one of the `capacity` slots shared by all workers. Returns the token to
+    pass to release_slot. Raises ServiceBusy after WPS_SLOT_WAIT_SECONDS.
+    """
+    deadline = time() + WPS_SLOT_WAIT_SECONDS
+    local = _process_slots.get(service)
+    if local is not None and not local.acquire(timeout=WPS_SLOT_WAIT_SECONDS):
+        raise ServiceBusy(f"No {service} slot in this worker for {WPS_SLOT_WAIT_SECONDS}s")
+    try:
+        if capacity is None:
+            return None
+        return _acquire_shared_slot(service, capacity, deadline)
+    except BaseException:
+        if local is not None:
+            local.release()
+        raise
+
+
+def release_slot(service, token):
+    """Release a slot returned by acquire_slot (`token` may be None)."""
+    local = _process_slots.get(service)
+    if local is not None:
+        local.release()
+    if token is None:
+        return
+    with _held_lock:
+        _held_slots.pop(token, None)
+    try:
+        conn.zrem(_slots_key(service), token)
+    except redis.RedisError as e:
+        print(f"❗ Could not release {service} slot: {e}")
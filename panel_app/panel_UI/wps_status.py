@@ -0,0 +1,177 @@
+"""
+Helpers for asynchronous WPS executions: waiting for completion, attaching to
+an execution from its status URL and reading its outputs.
+
+Waits go through a single StatusPoller per process. It tracks every
+outstanding status URL (executions sharing a URL are polled once) and backs off
+adaptively: it polls rarely while a process is queued or progressing slowly and
+again close to its expected completion.
+
+This module only depends on owslib so that the legacy notebook helpers can
+share it without loading the Panel app configuration.
+"""
+
+import os
+import threading
+from concurrent.futures import Future
+from time import monotonic
+from owslib.wps import WPSExecution
+
+WPS_POLL_MIN_SECONDS = float(os.getenv("WPS_POLL_MIN_SECONDS", "2"))
+WPS_POLL_MAX_SECONDS = float(os.getenv("WPS_POLL_MAX_SECONDS", "60"))
+# Waits fail once an execution's status could not be read for this long
+WPS_STATUS_UNREADABLE_SECONDS = float(os.getenv("WPS_STATUS_UNREADABLE_SECONDS", "600"))
+
+
+class StatusPoller:
+    """Background thread resolving futures as WPS executions complete."""
+
+    def __init__(
+        self,
+        min_interval=WPS_POLL_MIN_SECONDS,
+        max_interval=WPS_POLL_MAX_SECONDS,
+        unreadable_timeout=WPS_STATUS_UNREADABLE_SECONDS,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.unreadable_timeout = unreadable_timeout
+        self._tracked = {}
+        self._wakeup = threading.Condition()
+        self._thread = None
+
+    def watch(self, execution):
+        """Return a Future resolved with `execution` once it has completed."""
+        future = Future()
+        if execution.isComplete():
+            self._resolve(execution, [future])
+            return future
+
+        now = monotonic()
+        with self._wakeup:
+            entry = self._tracked.get(execution.statusLocation)
+            if entry is None:
+                self._tracked[execution.statusLocation] = {
+                    "execution": execution,
+                    "futures": [future],
+                    "started": now,
+                    "interval": self.min_interval,
+                    "next_check": now + self.min_interval,
+                    "progress": execution.percentCompleted or 0,
+                    "unreadable_since": None,
+                }
+            else:
+                entry["futures"].append(future)
+            self._ensure_running()
+            self._wakeup.notify()
+        return future
+
+    def _ensure_running(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="wps-status-poller", daemon=True
+            )
+            self._thread.start()
+
+    def _next_interval(self, entry, progress, now):
+        if progress > entry["progress"]:
+            # Check again around a quarter of the estimated remaining time
+            elapsed = now - entry["started"]
+            remaining = elapsed * (100 - progress) / max(progress, 1)
+            interval = remaining / 4
+        else:
+            # Queued or no visible progress: back off
+            interval = entry["interval"] * 1.5
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def _check(self, status_url, entry):
+        execution = entry["execution"]
+        now = monotonic()
+        try:
+            execution.checkStatus(sleepSecs=0)
+            entry["unreadable_since"] = None
+        except Exception as e:
+            print(f"❗ Could not read WPS status {status_url}: {e}")
+            entry["unreadable_since"] = entry["unreadable_since"] or now
+            if now - entry["unreadable_since"] >= self.unreadable_timeout:
+                # Status document gone or service down: stop waiting, so the
+                # stage fails and releases its admission slots
+                with self._wakeup:
+                    self._tracked.pop(status_url, None)
+                error = RuntimeError(
+                    f"WPS status {status_url} unreadable for "
+                    f"{now - entry['unreadable_since']:.0f} s: {e}"
+                )
+                for future in entry["futures"]:
+                    future.set_exception(error)
+                return
+
+        if execution.isComplete():
+            with self._wakeup:
+                self._tracked.pop(status_url, None)
+            self._resolve(execution, entry["futures"])
+            return
+
+        progress = execution.percentCompleted or 0
+        with self._wakeup:
+            entry["interval"] = self._next_interval(entry, progress, now)
+            entry["progress"] = progress
+            entry["next_check"] = now + entry["interval"]
+
+    @staticmethod
+    def _resolve(execution, futures):
+        if execution.isSucceded():
+            for future in futures:
+                future.set_result(execution)
+            return
+        errors = "; ".join(f"{err.code}: {err.text}" for err in (execution.errors or []))
+        error = RuntimeError(
+            f"WPS process {execution.statusLocation} failed: "
+            f"{errors or execution.statusMessage}"
+        )
+        for future in futures:
+            future.set_exception(error)
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                now = monotonic()
+                due = [
+                    (url, entry)
+                    for url, entry in self._tracked.items()
+                    if entry["next_check"] <= now
+                ]
+                if not due:
+                    next_check = min(
+                        (entry["next_check"] for entry in self._tracked.values()),
+                        default=now + self.max_interval,
+                    )
+                    self._wakeup.wait(next_check - now)
+                    continue
+            for url, entry in due:
+                self._check(url, entry)
+
+
+poller = StatusPoller()
+
+
+def wait_for_execution(execution):
+    """
+    Block until an asynchronous WPS execution completes.
+    Raises with the service's error report if it did not succeed.
+    """
+    return poller.watch(execution).result()
+
+
+def execution_from_status_url(status_url):
+    """An execution object tracking an existing WPS run by its status document."""
+    execution = WPSExecution()
+    execution.checkStatus(url=status_url, sleepSecs=0)
+    return execution
+
+
+def first_output_url(execution):
+    """Reference (or inline value) of the first output of a finished execution."""
+    output = execution.processOutputs[0]
+    if output.reference:
+        return output.reference
+    return output.data[0] if output.data else None
@@ -1,47 +1,50 @@
 from .config import (
     finch,
     chickadee,
-    CLIM_VARS,
     THREDDS_BASE,
-    THREDDS_CATALOG,
     DEFAULT_START_DATE,
     DEFAULT_END_DATE,
-    pcic_blend_url,
-    cmip6_url,
-    cmip6_catalog_url,
-    canada_mosaic_url,
+    TASMEAN_ENGINE,
+    CHICKADEE_DEFAULT_GB,
+    CHICKADEE_CAPACITY,
+    FINCH_CAPACITY,
 )
+from .coordinate_axis import get_axis
+from .dataset_metadata import dim_length, time_metadata
+from .coalesce import run_coalesced
+from .job_cost import record_stage_timing
+from .local_tasmean import compute_tasmean
+from .intermediates import release_pins, service_input
+from .pr_percentile import get_pr_percentile_file
+from .result_cache import canonical_key
+from .wps_admission import (
+    ServiceBusy,
+    acquire_slot,
+    busy_backoff,
+    is_server_busy,
+    mark_busy,
+    release_slot,
+)
+from .wps_status import first_output_url, wait_for_execution
 from .panel_helpers import (
     get_index_range,
     get_time_range,
     get_output_thredds_location,
     get_output_thredds_fileserver_location,
     find_opendap_url,
+    index_input_variables,
+    resolve_downscaling_inputs,
     setup_index_process_params,
 )
 
-import requests
-import xml.etree.ElementTree as ET
-from netCDF4 import Dataset
-from time import sleep
-import os
-import tempfile
 from inspect import getfullargspec
+from time import time
 
 
-def run_single_downscaling(ds_params):
-    clim_var = ds_params["clim_var"]
-    model = ds_params["model"]
-    technique = ds_params["technique"]
-    canesm5_run = ds_params.get("canesm5_run")
-    scenario = ds_params["scenario"]
-    period = ds_params["period"]
-    region = ds_params["region"]
-    center_point = ds_params.get("center_point")
-    bounds = ds_params.get("bounds", {})
-    dataset = ds_params["dataset"]
-    dataset_name = dataset.split(" ")[0]
-
+def _build_subset_urls(
+    gcm_file, obs_file, gcm_var, obs_var, bounds, period, dataset_name
+):
+    """OPeNDAP subset URLs of the GCM and obs files for the selected box and period."""
     # Unpack bounds
     lat_min_obs = bounds.get("lat_min_obs")
     lat_max_obs = bounds.get("lat_max_obs")
@@ -52,69 +55,19 @@ def run_single_downscaling(ds_params):
     lon_min_gcm = bounds.get("lon_min_gcm")
     lon_max_gcm = bounds.get("lon_max_gcm")
 
-    if clim_var == "tasmean":
-        gcm_var = "tasmax"
-    else:
-        gcm_var = clim_var
-    obs_var = CLIM_VARS[clim_var]
-
-    if dataset_name == "PCIC-Blend":
-        gcm_file = pcic_blend_url(gcm_var)
-    else:
-        if technique == "BCCAQv2":
-            technique_dir = "BCCAQ2"
-            model_dir = model
-        else:
-            technique_dir = "MBCn"
-            model_dir = model + "_10"
-        model_catalog = cmip6_catalog_url(technique_dir, technique, model_dir)
-
-        r = requests.get(model_catalog)
-        r.raise_for_status()
-
-        root = ET.fromstring(r.content)
-        ns = {
-            "thredds": "http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"
-        }
-
-        file = ""
-        # Locate the filename in THREDDS based on the parameter values
-        for dataset in root.findall(".//thredds:dataset", ns):
-            file = dataset.get("name")
-            if file and (gcm_var in file) and (scenario in file):
-                if (model == "CanESM5") and (canesm5_run not in file):
-                    continue
-                break
-        if not file:
-            raise LookupError(
-                f"No file found for var={gcm_var}, scenario={scenario}, model={model}, technique={technique}"
-            )
-        gcm_file = cmip6_url(technique_dir, technique, model_dir, file)
-
-    obs_file = canada_mosaic_url(obs_var)
-    print(f"Using GCM file: {gcm_file}")
-    print(f"Using Obs file: {obs_file}")
-    gcm_dataset = Dataset(gcm_file)
-    obs_dataset = Dataset(obs_file)
-    print(f"{gcm_dataset.variables.keys()}")
-    print(f"{obs_dataset.variables.keys()}")
-    # Obtain the datasets' latitudes and longitudes to determine the subdomains
+    # Obtain the datasets' latitudes and longitudes to determine the subdomains.
+    # Axes are cached per process, so only the first job per file reads them.
     try:
         print(f"Reading GCM: lat, lon")
-        gcm_lats = gcm_dataset.variables["lat"][:]
-        gcm_lons = gcm_dataset.variables["lon"][:]
-        obs_lats = obs_dataset.variables["lat"][:]
-        obs_lons = obs_dataset.variables["lon"][:]
+        gcm_lats = get_axis(gcm_file, "lat")
+        gcm_lons = get_axis(gcm_file, "lon")
+        obs_lats = get_axis(obs_file, "lat")
+        obs_lons = get_axis(obs_file, "lon")
         print("✅ Successfully read lat/lon arrays.")
     except Exception as e:
         print(f"❗ ERROR reading lat/lon: {e}")
         raise
-    print(f"Fetching index range:")
     # Use the stored subdomain bounds from the map interaction
-    gcm_lat_indices = get_index_range(gcm_lats, lat_min_gcm, lat_max_gcm)
-    gcm_lon_indices = get_index_range(gcm_lons, lon_min_gcm, lon_max_gcm)
-    obs_lat_indices = get_index_range(obs_lats, lat_min_obs, lat_max_obs)
-    obs_lon_indices = get_index_range(obs_lons, lon_min_obs, lon_max_obs)
     try:
         print(f"Reading GCM: lat, lon indices")
         gcm_lat_indices = get_index_range(gcm_lats, lat_min_gcm, lat_max_gcm)
@@ -130,38 +83,67 @@ def run_single_downscaling(ds_params):
     obs_lat_range = f"[{obs_lat_indices[0]}:{obs_lat_indices[1]}]"
     obs_lon_range = f"[{obs_lon_indices[0]}:{obs_lon_indices[1]}]"
 
-    # Use full time range of PCIC-Blend datasets, but user-specified range for CMIP6
+    # Use full time range of PCIC-Blend datasets, but user-specified range for CMIP6.
+    # Lengths, units and calendar come from the cached DDS/DAS headers.
     print("Setting time ranges")
     if dataset_name == "PCIC-Blend":
-        gcm_ntime = len(gcm_dataset.variables["time"][:])
+        gcm_ntime = dim_length(gcm_file, "time")
         gcm_time_range = f"[0:{gcm_ntime - 1}]"
     else:
-        gcm_time_range = get_time_range(gcm_dataset, period)
-    obs_ntime = len(obs_dataset.variables["time"][:])
+        gcm_time_range = get_time_range(time_metadata(gcm_file), period)
+    obs_ntime = dim_length(obs_file, "time")
     obs_time_range = f"[0:{obs_ntime - 1}]"
 
     # Request a subset of each dataset based on the array indices for each subdomain
     gcm_subset_file = f"{gcm_file}?time{gcm_time_range},lat{gcm_lat_range},lon{gcm_lon_range},{gcm_var}{gcm_time_range}{gcm_lat_range}{gcm_lon_range}"
     obs_subset_file = f"{obs_file}?time{obs_time_range},lat{obs_lat_range},lon{obs_lon_range},climatology_bounds,crs,{obs_var}{obs_time_range}{obs_lat_range}{obs_lon_range}"
 
-    # If tasmean is requested, compute it via finch using the tasmax and tasmin subsets
+    return gcm_subset_file, obs_subset_file
+
+
+def collect_downscaling(ci_process, clim_var):
+    final_output = first_output_url(ci_process)
+    print(f"Final output (HTTP download): {final_output}")
+    return {
+        "clim_var": clim_var,
+        "fileserver_url": get_output_thredds_fileserver_location(final_output),
+        "status_url": ci_process.statusLocation,
+        "opendap_url": get_output_thredds_location(final_output),
+    }
+
+
+def collect_index(process_result):
+    return {"output_url": first_output_url(process_result)}
+
+
+# Rebuild results from a finished execution, by the "kind" of its collect_spec
+# (used to resume executions orphaned by a worker restart)
+COLLECTORS = {"downscale": collect_downscaling, "index": collect_index}
+
+
+def run_single_downscaling(ds_params, cost=None):
+    clim_var = ds_params["clim_var"]
+    model = ds_params["model"]
+    technique = ds_params["technique"]
+    canesm5_run = ds_params.get("canesm5_run")
+    scenario = ds_params["scenario"]
+    period = ds_params["period"]
+    region = ds_params["region"]
+    center_point = ds_params.get("center_point")
+    bounds = ds_params.get("bounds", {})
+    dataset = ds_params["dataset"]
+    dataset_name = dataset.split(" ")[0]
+
+    gcm_file, obs_file, gcm_var, obs_var = resolve_downscaling_inputs(ds_params)
+    print(f"Using GCM file: {gcm_file}")
+    print(f"Using Obs file: {obs_file}")
+    gcm_subset_file, obs_subset_file = _build_subset_urls(
+        gcm_file, obs_file, gcm_var, obs_var, bounds, period, dataset_name
+    )
+
+    # tasmean is computed from the tasmax and tasmin subsets before downscaling
     if clim_var == "tasmean":
         gcm_var = "tasmean"
-        tasmax_file = gcm_subset_file
-        tasmin_file = tasmax_file.replace("tasmax", "tasmin")
-        print("Starting tasmean process")
-        tasmean = finch.tg(
-            tasmax=tasmax_file, tasmin=tasmin_file, output_name="tasmean"
-        )
-        while tasmean.isNotComplete():
-            sleep(3)
-        gcm_file = (
-            THREDDS_BASE + "/ODDS_outputs" + tasmean.get()[0].split("wpsoutputs")[1]
-        )
-        gcm_subset_file = gcm_file
-
-    gcm_dataset.close()
-    obs_dataset.close()
 
     # Put together the parameters for chickadee.ci
     region_name = region.lower().replace(" ", "-")
@@ -171,7 +153,8 @@ def run_single_downscaling(ds_params):
         "obs_file": obs_subset_file,
         "gcm_varname": gcm_varname,
         "obs_varname": obs_var,
-        "max_gb": 0.5,
+        # Chunk size sized to the subset by job_cost (older jobs have no estimate)
+        "max_gb": cost["max_gb"] if cost else CHICKADEE_DEFAULT_GB,
         "start_date": DEFAULT_START_DATE,
         "end_date": DEFAULT_END_DATE,
     }
@@ -195,157 +178,213 @@ def run_single_downscaling(ds_params):
                 f"{gcm_var}_{dataset_name}_{technique}_{model}_{scenario}_{period}_{region_name}.nc"
             )
 
-    try:
+    # max_gb only affects how chickadee chunks the work, not the output.
+    cache_inputs = {k: v for k, v in chickadee_params.items() if k != "max_gb"}
+    cache_key = canonical_key(
+        "downscale", {"clim_var": clim_var, "chickadee": cache_inputs}
+    )
+
+    submitted_at = []
+    slots = []
+    pins = []
+
+    def submit():
+        # If tasmean is requested, compute it from the tasmax and tasmin subsets
+        if clim_var == "tasmean":
+            tasmax_file = gcm_subset_file
+            tasmin_file = tasmax_file.replace("tasmax", "tasmin")
+            print(f"Starting tasmean process ({TASMEAN_ENGINE})")
+            started = time()
+            if TASMEAN_ENGINE == "local":
+                # Pinned until chickadee is done with it
+                chickadee_params["gcm_file"] = compute_tasmean(
+                    tasmax_file, tasmin_file, pins
+                )
+            else:
+                token = acquire_slot("finch", FINCH_CAPACITY)
+                try:
+                    tasmean = finch.tg(
+                        tasmax=tasmax_file, tasmin=tasmin_file, output_name="tasmean"
+                    )
+                    wait_for_execution(tasmean)
+                except Exception as e:
+                    if is_server_busy(e):
+                        # finch is full, not chickadee: hold off finch submissions
+                        mark_busy("finch", busy_backoff(0))
+                        raise ServiceBusy(f"finch: {e}") from e
+                    raise
+                finally:
+                    release_slot("finch", token)
+                chickadee_params["gcm_file"] = (
+                    THREDDS_BASE
+                    + "/ODDS_outputs"
+                    + tasmean.get()[0].split("wpsoutputs")[1]
+                )
+            print(f"tasmean ready after {time() - started:.1f}s")
+
+        # Wait for one of our chickadee slots so its queue never overflows
+        slots.append(acquire_slot("chickadee", CHICKADEE_CAPACITY))
+        # Timings model chickadee's runtime: no slot waits, no tasmean
+        submitted_at.append(time())
         print(f"Starting downscaling process for variable {clim_var} ")
         ci_process = chickadee.ci(**chickadee_params)
         print(f"Status URL: {ci_process.statusLocation}")
         print("ci proc:", ci_process)
-        final_output = ci_process.get()[0]
+        return ci_process
 
-        print(f"Final output (HTTP download): {final_output}")
+    def collect(ci_process):
+        # Only executions run for this job say something about runtimes
+        if submitted_at and cost:
+            record_stage_timing("downscale", cost["output_gb"], time() - submitted_at[0])
+        return collect_downscaling(ci_process, clim_var)
 
+    # Identical requests reuse a cached output or attach to the running execution
+    try:
+        return run_coalesced(
+            cache_key,
+            submit,
+            collect,
+            collect_spec={"kind": "downscale", "args": {"clim_var": clim_var}},
+        )
+    except ServiceBusy as e:
+        print(f"⚠️ SERVER BUSY ({e}), the job will be requeued")
+        raise
     except Exception as e:
-        error_message = str(e)
-        if (
-            "ServerBusy" in error_message
-            and "Maximum number of processes in queue reached" in error_message
-        ):
+        if is_server_busy(e):
             print("⚠️ SERVER BUSY")
             print(
-                "The processing queue is currently full. Your job cannot be submitted at this time."
+                "The processing queue is currently full. The job will be requeued."
             )
-            print("Please wait for jobs to complete and try again")
+            # Keep every worker from submitting to chickadee for a while
+            mark_busy("chickadee", busy_backoff(0))
+            raise ServiceBusy(str(e)) from e
         else:
             print(f"⚠️ ERROR: An unexpected error occurred during downscaling:")
             print(f"{str(e)}")
             print("Please check your inputs and try again.")
         raise
-    print("ci proc:", ci_process)
+    finally:
+        for token in slots:
+            release_slot("chickadee", token)
+        release_pins(pins)
+
+
+def _parse_number(value, default=None):
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        token = value.strip().split(" ", 1)[0]
+        try:
+            return float(token)
+        except ValueError:
+            return default
+    return default
 
-    return {
-        "clim_var": clim_var,
-        "fileserver_url": get_output_thredds_fileserver_location(final_output),
-        "status_url": ci_process.statusLocation,
-        "opendap_url": get_output_thredds_location(final_output),
+
+def index_process_spec(ix_params):
+    """
+    The process an index is computed with: {"identifier" (finch process / xclim
+    indicator), "threshold", "variables" (downscaled inputs, in process input
+    order), "percentile" ((percentile, wet-day threshold) of the pr_per
+    reference the process needs, or None)}.
+    """
+    func_name = ix_params["func_name"]
+    threshold = ix_params.get("threshold")
+    spec = {
+        "identifier": func_name,
+        "threshold": threshold,
+        "variables": index_input_variables(ix_params["variable"], func_name),
+        "percentile": None,
     }
+    if func_name == "days_over_precip_thresh":
+        # Finch expects both pr and pr_per datasets.
+        threshold_dict = threshold if isinstance(threshold, dict) else {}
+        percentile = _parse_number(threshold_dict.get("percentile"), default=95.0)
+        wetday_thresh = _parse_number(threshold_dict.get("thresh"), default=1.0)
+        if percentile <= 0:
+            # Threshold-only mode: delegate to wetdays.
+            spec["identifier"] = "wetdays"
+            spec["threshold"] = threshold_dict.get("thresh", "1 mm/day")
+        else:
+            spec["percentile"] = (percentile, wetday_thresh)
+    return spec
 
 
-def run_single_index(ix_params, downscaling_outputs):
-    func_name = ix_params["func_name"]
-    variable = ix_params["variable"]
+def run_single_index(ix_params, downscaling_outputs, cost=None):
     resolution = ix_params.get("resolution")
-    threshold = ix_params.get("threshold")
     index_name = ix_params["index_name"]
     region_name = ix_params.get("region")
-    temp_files = []
+    slots = []
+    pins = []
 
     try:
-        process = getattr(finch, func_name)
-        params_identifier = func_name
-        params_threshold = threshold
-        opendap_urls = []
-
-        def _parse_number(value, default=None):
-            if value is None:
-                return default
-            if isinstance(value, (int, float)):
-                return float(value)
-            if isinstance(value, str):
-                token = value.strip().split(" ", 1)[0]
-                try:
-                    return float(token)
-                except ValueError:
-                    return default
-            return default
-
-        def _build_pr_percentile_file(pr_url, percentile, wetday_thresh):
-            import xarray as xr
-
-            ds = xr.open_dataset(pr_url)
-            try:
-                if "pr" in ds.data_vars:
-                    source_var_name = "pr"
-                    pr = ds[source_var_name]
-                else:
-                    source_var_name = next(iter(ds.data_vars))
-                    pr = ds[source_var_name]
-                wet = pr.where(pr >= wetday_thresh)
-                pr_per = wet.quantile(
-                    percentile / 100.0, dim="time", skipna=True, keep_attrs=True
-                )
-                if "quantile" in pr_per.dims:
-                    pr_per = pr_per.squeeze("quantile", drop=True)
-                pr_per = pr_per.rename("pr_per")
-                # Finch/xclim unit checks require units on percentile input.
-                pr_per.attrs = dict(pr.attrs)
-                if "units" not in pr_per.attrs and "units" in ds[source_var_name].attrs:
-                    pr_per.attrs["units"] = ds[source_var_name].attrs["units"]
-                fd, tmp_path = tempfile.mkstemp(prefix="odds_pr_per_", suffix=".nc")
-                os.close(fd)
-                pr_per.to_dataset().to_netcdf(tmp_path)
-                return tmp_path
-            finally:
-                ds.close()
-
-        if variable == "multivar":
-            if func_name in {"prsn", "prlp"}:
-                # Snow/rain partitioning requires precipitation + mean temperature.
-                pr_url = find_opendap_url("pr", downscaling_outputs)
-                tasmean_url = find_opendap_url("tasmean", downscaling_outputs)
-                opendap_urls = [pr_url, tasmean_url]
-            elif func_name == "heat_wave_index":
-                # Heat wave days process uses tasmax + single threshold.
-                tasmax_url = find_opendap_url("tasmax", downscaling_outputs)
-                opendap_urls = [tasmax_url]
-            elif func_name in {"heat_wave_frequency", "heat_wave_max_length"}:
-                # Heat wave number/max length use tasmin + tasmax.
-                tasmin_url = find_opendap_url("tasmin", downscaling_outputs)
-                tasmax_url = find_opendap_url("tasmax", downscaling_outputs)
-                opendap_urls = [tasmin_url, tasmax_url]
-            else:
-                # Remaining multivariate temperature indices use tasmin + tasmax.
-                tasmin_url = find_opendap_url("tasmin", downscaling_outputs)
-                tasmax_url = find_opendap_url("tasmax", downscaling_outputs)
-                opendap_urls = [tasmin_url, tasmax_url]
-        elif func_name == "days_over_precip_thresh":
-            # Finch expects both pr and pr_per datasets.
-            pr_url = find_opendap_url("pr", downscaling_outputs)
-            threshold_dict = threshold if isinstance(threshold, dict) else {}
-            percentile = _parse_number(threshold_dict.get("percentile"), default=95.0)
-            wetday_thresh = _parse_number(threshold_dict.get("thresh"), default=1.0)
-
-            if percentile <= 0:
-                # Threshold-only mode: delegate to wetdays.
-                process = getattr(finch, "wetdays")
-                params_identifier = "wetdays"
-                params_threshold = threshold_dict.get("thresh", "1 mm/day")
-                opendap_urls = [pr_url]
-            else:
-                pr_per_file = _build_pr_percentile_file(pr_url, percentile, wetday_thresh)
-                temp_files.append(pr_per_file)
-                opendap_urls = [pr_url, pr_per_file]
-        else:
-            opendap_urls = [find_opendap_url(variable, downscaling_outputs)]
+        spec = index_process_spec(ix_params)
+        params_identifier = spec["identifier"]
+        process = getattr(finch, params_identifier)
+        opendap_urls = [
+            find_opendap_url(var, downscaling_outputs) for var in spec["variables"]
+        ]
+        pr_per_spec = None
+
+        if spec["percentile"] is not None:
+            # Built by the submitting worker only; see submit() below
+            pr_per_spec = (opendap_urls[0], *spec["percentile"])
 
         if not opendap_urls or any(url is None for url in opendap_urls):
             return f"{index_name}: ❌ No input file"
 
         params = setup_index_process_params(
-            params_identifier, resolution, params_threshold, region_name
+            params_identifier, resolution, spec["threshold"], region_name
         )
         accepted_args = set(getfullargspec(process).args)
         params = {k: v for k, v in params.items() if k in accepted_args}
-        process_result = process(*opendap_urls, **params)
-        output_url = process_result.get()[0]
+        cache_key = canonical_key(
+            "index",
+            {
+                "process": params_identifier,
+                "inputs": opendap_urls,
+                "pr_per": pr_per_spec,
+                "params": params,
+            },
+        )
+
+        submitted_at = []
+
+        def submit():
+            inputs = list(opendap_urls)
+            if pr_per_spec is not None:
+                # A URL finch fetches, rather than a file embedded in the request
+                # Pinned until finch is done with it
+                inputs.append(service_input(get_pr_percentile_file(*pr_per_spec, pins)))
+            slots.append(acquire_slot("finch", FINCH_CAPACITY))
+            # Timings model finch's runtime: no slot waits, no percentile
+            submitted_at.append(time())
+            return process(*inputs, **params)
+
+        def collect(process_result):
+            if submitted_at and cost:
+                record_stage_timing("index", cost["input_gb"], time() - submitted_at[0])
+            return collect_index(process_result)
+
+        output_url = run_coalesced(
+            cache_key, submit, collect, collect_spec={"kind": "index", "args": {}}
+        )["output_url"]
 
         return f"{index_name}: {get_output_thredds_fileserver_location(output_url)}"
 
+    except ServiceBusy:
+        # Requeue the job; indices already computed are kept in its checkpoint
+        print(f"⚠️ SERVER BUSY: no finch capacity for {index_name}, the job will be requeued")
+        raise
     except Exception as e:
+        if is_server_busy(e):
+            print(f"⚠️ SERVER BUSY: finch refused {index_name}, the job will be requeued")
+            mark_busy("finch", busy_backoff(0))
+            raise ServiceBusy(str(e)) from e
         return f"{index_name}: ❌ Error {str(e)}"
     finally:
-        for path in temp_files:
-            try:
-                if path and os.path.exists(path):
-                    os.remove(path)
-            except Exception:
-                pass
+        for token in slots:
+            release_slot("finch", token)
+        release_pins(pins)
@@ -1,8 +1,12 @@
 import panel as pn
 from panel_UI.config import APP_NAME
+from panel_UI.catalog_index import start_catalog_refresher
+from panel_UI.mask_index import start_mask_index_builds
 from panel_UI.state import get_header_pane, get_main_pane, get_help_pane, render
 
 pn.extension("ipywidgets")
+start_catalog_refresher()
+start_mask_index_builds()
 
 render()
 pn.Column(get_header_pane(), get_main_pane(), pn.layout.HSpacer(), get_help_pane()).servable(
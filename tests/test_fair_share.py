@@ -0,0 +1,155 @@
+import threading
+from time import sleep
+from unittest import mock
+
+import birdy
+import fakeredis
+import pytest
+from rq.executions import Execution
+from rq.job import JobStatus
+
+# config.py connects to the WPS services on import
+with mock.patch.object(birdy, "WPSClient"):
+    from panel_app.panel_UI import fair_share
+    from panel_app.panel_UI.job_queues import all_job_queues, get_job_queue
+
+
+@pytest.fixture
+def r(monkeypatch):
+    connection = fakeredis.FakeRedis()
+    monkeypatch.setattr(fair_share, "conn", connection)
+    monkeypatch.setattr(fair_share, "FAIR_SHARE_USER_INFLIGHT", 2)
+    monkeypatch.setattr(fair_share, "FAIR_SHARE_READY_JOBS", 1)
+    return connection
+
+
+def submit(r, user, queue_name="medium"):
+    return fair_share.submit_job(
+        queue_name,
+        "builtins.print",
+        (user,),
+        user,
+        meta={"cost": {"runtime_seconds": 1800}},
+        connection=r,
+    )
+
+
+def submit_burst(r, monkeypatch, users):
+    """
+    Submit jobs faster than the workers take them: each queue fills up with
+    one ready job, the others wait in the pending lists.
+    """
+    with monkeypatch.context() as m:
+        m.setattr(fair_share, "dispatch", lambda *args, **kwargs: None)
+        for user in users:
+            submit(r, user)
+    fair_share.dispatch(r)
+
+
+def start(r, job):
+    """Move a dequeued job to the started registry, as a worker would."""
+    with r.pipeline() as pipeline:
+        Execution.create(job, ttl=600, pipeline=pipeline)
+        job.set_status(JobStatus.STARTED, pipeline=pipeline)
+        pipeline.execute()
+
+
+def idle_workers(r, count, max_idle_time=3):
+    """Start `count` workers blocked on the empty queues; returns (threads, results)."""
+    results = [None] * count
+
+    def run(i):
+        worker = fair_share.FairShareWorker(
+            all_job_queues(r), connection=r, name=f"worker-{i}"
+        )
+        results[i] = worker.dequeue_job_and_maintain_ttl(1, max_idle_time)
+        if results[i] is not None:
+            start(r, results[i][0])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    # Let every worker dispatch (nothing yet) and block on the queues
+    sleep(0.5)
+    return threads, results
+
+
+def test_dispatch_keeps_one_ready_job_per_queue(r):
+    for user in ("a@x", "b@x", "c@x"):
+        submit(r, user)
+    assert get_job_queue("medium", r).count == 1
+    assert len(fair_share.pending_job_ids(r)) == 2
+
+
+def test_dispatch_round_robin_and_user_cap(r):
+    for user in ("a@x", "a@x", "a@x", "b@x"):
+        submit(r, user)
+    queue = get_job_queue("medium", r)
+    users = []
+    for _ in range(4):
+        job = queue.dequeue_any([queue], None, connection=r)[0]
+        users.append(job.meta["user_email"])
+        fair_share.dispatch(r, starting=(job,))
+        start(r, job)
+        if queue.count == 0:
+            break
+    # a@x is capped at two jobs in flight: its third one stays pending
+    assert users == ["a@x", "a@x", "b@x"]
+    assert len(fair_share.pending_job_ids(r)) == 1
+
+
+def test_idle_workers_all_get_jobs(r, monkeypatch):
+    threads, results = idle_workers(r, 3)
+    submit_burst(r, monkeypatch, ("a@x", "b@x", "c@x", "a@x", "b@x"))
+    for thread in threads:
+        thread.join()
+
+    # Every blocked worker took a job, one per user, in round-robin order
+    assert all(result is not None for result in results)
+    users = sorted(result[0].meta["user_email"] for result in results)
+    assert users == ["a@x", "b@x", "c@x"]
+    # The next job is ready for the next worker to come back
+    assert get_job_queue("medium", r).count == 1
+    assert len(fair_share.pending_job_ids(r)) == 1
+
+
+def test_dequeued_job_counts_toward_user_cap(r, monkeypatch):
+    monkeypatch.setattr(fair_share, "FAIR_SHARE_USER_INFLIGHT", 1)
+    threads, results = idle_workers(r, 2, max_idle_time=2)
+    for _ in range(3):
+        submit(r, "a@x")
+        sleep(0.3)
+    for thread in threads:
+        thread.join()
+
+    # The user's second job waits for the first to finish
+    assert sum(result is not None for result in results) == 1
+    assert get_job_queue("medium", r).count == 0
+    assert len(fair_share.pending_job_ids(r)) == 2
+
+
+def test_delayed_submission_waits_its_turn(r):
+    submit(r, "a@x")
+    job = fair_share.submit_job(
+        "medium", "builtins.print", ("b@x",), "b@x", connection=r, delay=0.5
+    )
+    assert job.get_status() == JobStatus.SCHEDULED
+    assert fair_share.pending_job_ids(r) == []
+
+    sleep(0.6)
+    later = submit(r, "c@x")
+    # Released into b@x's pending list, ahead of the later submission only
+    assert job.get_status() == JobStatus.CREATED
+    assert get_job_queue("medium", r).count == 1
+    assert fair_share.pending_job_ids(r) == [job.id, later.id]
+
+
+def test_idle_worker_releases_delayed_job(r, monkeypatch):
+    monkeypatch.setattr(fair_share, "FAIR_SHARE_POLL_SECONDS", 1)
+    threads, results = idle_workers(r, 1, max_idle_time=5)
+    job = fair_share.submit_job(
+        "medium", "builtins.print", ("a@x",), "a@x", connection=r, delay=1
+    )
+    # Nothing else dispatches: the blocked worker comes back for it
+    threads[0].join()
+    assert results[0][0].id == job.id
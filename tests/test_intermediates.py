@@ -0,0 +1,148 @@
+import os
+import threading
+from time import sleep, time
+from unittest import mock
+
+import birdy
+import fakeredis
+import pytest
+
+# config.py connects to the WPS services on import
+with mock.patch.object(birdy, "WPSClient"):
+    from panel_app.panel_UI import intermediates, local_tasmean, pr_percentile
+
+
+@pytest.fixture
+def r(monkeypatch):
+    connection = fakeredis.FakeRedis()
+    monkeypatch.setattr(intermediates, "conn", connection)
+    return connection
+
+
+def write(directory, name, mb=1, age=3600):
+    """A cached file of `mb` MB last used `age` seconds ago."""
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * mb * 2**20)
+    os.utime(path, (time() - age, time() - age))
+    return path
+
+
+def test_evict_lru_removes_oldest_unpinned(r, tmp_path):
+    oldest = write(tmp_path, "a.nc", age=7200)
+    pinned = write(tmp_path, "b.nc", age=5400)
+    newer = write(tmp_path, "c.nc", age=3600)
+    pins = [(pinned, intermediates.pin(pinned))]
+
+    intermediates.evict_lru(tmp_path, 1)
+    # The pinned file is kept even though it is over the limit
+    assert not os.path.exists(oldest)
+    assert os.path.exists(pinned)
+    assert not os.path.exists(newer)
+
+    intermediates.release_pins(pins)
+    assert pins == []
+    intermediates.evict_lru(tmp_path, 0)
+    assert not os.path.exists(pinned)
+
+
+def test_evict_lru_keeps_recent_files(r, tmp_path):
+    recent = write(tmp_path, "a.nc", age=60)
+    intermediates.evict_lru(tmp_path, 0)
+    assert os.path.exists(recent)
+
+
+def test_expired_pins_lapse(r, tmp_path, monkeypatch):
+    path = write(tmp_path, "a.nc")
+    monkeypatch.setattr(intermediates, "INTERMEDIATE_PIN_LEASE_SECONDS", -1)
+    intermediates.pin(path)
+    intermediates.evict_lru(tmp_path, 0)
+    assert not os.path.exists(path)
+
+
+def test_cached_pr_percentile_is_pinned(r, tmp_path, monkeypatch):
+    monkeypatch.setattr(pr_percentile, "PR_PERCENTILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(pr_percentile, "PR_PERCENTILE_CACHE_MB", 0)
+    monkeypatch.setattr(
+        pr_percentile,
+        "build_pr_percentile_file",
+        lambda pr_url, percentile, wetday_thresh, path: write(
+            os.path.dirname(path), os.path.basename(path), age=7200
+        ),
+    )
+    pins = []
+    path = pr_percentile.get_pr_percentile_file("https://x/pr.nc", 95, 1, pins)
+    # Over the cache limit and old, but in use
+    intermediates.evict_lru(tmp_path, 0)
+    assert os.path.exists(path)
+    assert [p for p, _ in pins] == [path]
+
+    intermediates.release_pins(pins)
+    intermediates.evict_lru(tmp_path, 0)
+    assert not os.path.exists(path)
+
+
+@pytest.fixture
+def tasmean_store(r, tmp_path, monkeypatch):
+    monkeypatch.setattr(intermediates, "INTERMEDIATE_DIR", str(tmp_path))
+    monkeypatch.setattr(intermediates, "INTERMEDIATE_BASE_URL", "https://host/intermediates")
+    # Only the pins protect files here
+    monkeypatch.setattr(intermediates, "EVICT_MIN_AGE_SECONDS", 0)
+    monkeypatch.setattr(local_tasmean, "TASMEAN_DIR", str(tmp_path / "tasmean"))
+    monkeypatch.setattr(local_tasmean, "TASMEAN_CACHE_MB", 0)
+    monkeypatch.setattr(
+        local_tasmean,
+        "_write_tasmean",
+        lambda tasmax_url, tasmin_url, path: write(
+            os.path.dirname(path), os.path.basename(path)
+        ),
+    )
+    return tmp_path / "tasmean"
+
+
+def test_eviction_skips_tasmean_served_to_a_running_job(tasmean_store):
+    # One job's tasmean is being fetched by chickadee ...
+    held = []
+    url = local_tasmean.compute_tasmean("https://x/tasmax_a.nc", "https://x/tasmin_a.nc", held)
+    path = str(tasmean_store / os.path.basename(url))
+    # ... while another job's tasmean pushes the store over its limit
+    other = []
+    other_url = local_tasmean.compute_tasmean(
+        "https://x/tasmax_b.nc", "https://x/tasmin_b.nc", other
+    )
+    assert os.path.exists(path)
+    assert os.path.exists(str(tasmean_store / os.path.basename(other_url)))
+
+    intermediates.release_pins(held)
+    intermediates.evict_lru(tasmean_store, 0)
+    assert not os.path.exists(path)
+    intermediates.release_pins(other)
+
+
+def test_pin_waits_for_a_running_eviction(tasmean_store):
+    held = []
+    url = local_tasmean.compute_tasmean("https://x/tasmax_a.nc", "https://x/tasmin_a.nc", held)
+    path = str(tasmean_store / os.path.basename(url))
+    intermediates.release_pins(held)
+
+    result = []
+    consumer = threading.Thread(
+        target=lambda: result.append(
+            local_tasmean.compute_tasmean(
+                "https://x/tasmax_a.nc", "https://x/tasmin_a.nc", held
+            )
+        )
+    )
+    # An eviction sweep has found the file unpinned and is about to remove it
+    with intermediates._evict_lock(tasmean_store):
+        consumer.start()
+        sleep(0.5)
+        assert result == []
+        os.remove(path)
+    consumer.join()
+    # The consumer pinned it after the sweep: it saw it gone and recomputed it
+    assert result == [url]
+    assert os.path.exists(path)
+    intermediates.evict_lru(tasmean_store, 0)
+    assert os.path.exists(path)
+    intermediates.release_pins(held)
@@ -0,0 +1,166 @@
+from unittest import mock
+
+import birdy
+import fakeredis
+import pytest
+from rq.executions import Execution
+from rq.job import JobStatus
+
+# config.py connects to the WPS services on import
+with mock.patch.object(birdy, "WPSClient"):
+    from panel_app.panel_UI import fair_share, wps_admission, worker_autoscaler
+    from panel_app.panel_UI.job_queues import get_job_queue
+
+
+@pytest.fixture
+def r(monkeypatch):
+    connection = fakeredis.FakeRedis()
+    monkeypatch.setattr(wps_admission, "conn", connection)
+    monkeypatch.setattr(worker_autoscaler, "conn", connection)
+    monkeypatch.setattr(fair_share, "conn", connection)
+    monkeypatch.setattr(worker_autoscaler, "WORKER_MODE", "rq")
+    monkeypatch.setattr(worker_autoscaler, "AUTOSCALE_MIN_WORKERS", 1)
+    monkeypatch.setattr(worker_autoscaler, "AUTOSCALE_MAX_WORKERS", 8)
+    monkeypatch.setattr(worker_autoscaler, "AUTOSCALE_BACKLOG_SECONDS", 3600)
+    return connection
+
+
+def submit(r, user, runtime_seconds, queue_name="medium"):
+    return fair_share.submit_job(
+        queue_name,
+        "builtins.print",
+        (user,),
+        user,
+        meta={"cost": {"runtime_seconds": runtime_seconds}},
+        connection=r,
+    )
+
+
+def start(r, job):
+    """Move a queued job to the started registry, as a worker would."""
+    get_job_queue(job.origin, r).remove(job)
+    with r.pipeline() as pipeline:
+        Execution.create(job, ttl=600, pipeline=pipeline)
+        job.set_status(JobStatus.STARTED, pipeline=pipeline)
+        pipeline.execute()
+
+
+def backlog(waiting_jobs=0, backlog_seconds=0, running_jobs=0, saturated=()):
+    return {
+        "waiting_jobs": waiting_jobs,
+        "backlog_seconds": backlog_seconds,
+        "running_jobs": running_jobs,
+        "inflight": {},
+        "saturated": list(saturated),
+    }
+
+
+def test_collect_backlog_empty(r):
+    assert worker_autoscaler.collect_backlog(r) == dict(
+        backlog(), inflight={"chickadee": 0, "finch": 0}
+    )
+
+
+def test_collect_backlog_counts_pending_and_queued_jobs(r):
+    # One job of each user is dispatched to the RQ queue, the others stay pending
+    for user in ("a@x", "b@x", "a@x", "b@x", "a@x"):
+        submit(r, user, 1800)
+    assert get_job_queue("medium", r).count == 1
+    assert len(fair_share.pending_job_ids(r)) == 4
+
+    result = worker_autoscaler.collect_backlog(r)
+    assert result["waiting_jobs"] == 5
+    assert result["backlog_seconds"] == 5 * 1800
+    assert result["running_jobs"] == 0
+    assert result["saturated"] == []
+
+
+def test_collect_backlog_counts_running_jobs(r):
+    job = submit(r, "a@x", 1800)
+    start(r, job)
+    submit(r, "b@x", 600)
+
+    result = worker_autoscaler.collect_backlog(r)
+    assert result["running_jobs"] == 1
+    assert result["waiting_jobs"] == 1
+    assert result["backlog_seconds"] == 600
+
+
+def test_collect_backlog_ignores_stale_started_entries(r):
+    # The started registry is only cleaned periodically
+    job = submit(r, "a@x", 1800)
+    start(r, job)
+    job.set_status(JobStatus.FINISHED)
+
+    assert worker_autoscaler.collect_backlog(r)["running_jobs"] == 0
+
+
+def test_collect_backlog_saturated_services(r, monkeypatch):
+    monkeypatch.setattr(worker_autoscaler, "SERVICE_CAPACITIES", {"chickadee": 1, "finch": 6})
+    wps_admission.mark_busy("finch", 60)
+    r.zadd(wps_admission._slots_key("chickadee"), {"token": 2**40})
+
+    result = worker_autoscaler.collect_backlog(r)
+    assert result["inflight"] == {"chickadee": 1, "finch": 0}
+    assert sorted(result["saturated"]) == ["chickadee", "finch"]
+
+
+def test_desired_workers_idle_keeps_minimum(r):
+    assert worker_autoscaler.desired_workers(backlog(), current=3) == 1
+
+
+def test_desired_workers_one_slot_per_backlog_interval(r):
+    # 2.5 h of work -> 3 slots, on top of the 2 busy workers
+    wanted = worker_autoscaler.desired_workers(
+        backlog(waiting_jobs=10, backlog_seconds=9000, running_jobs=2), current=2
+    )
+    assert wanted == 5
+
+
+def test_desired_workers_at_least_one_slot_per_waiting_job(r):
+    wanted = worker_autoscaler.desired_workers(
+        backlog(waiting_jobs=1, backlog_seconds=60), current=0
+    )
+    assert wanted == 1
+    # ... but never more slots than waiting jobs
+    wanted = worker_autoscaler.desired_workers(
+        backlog(waiting_jobs=2, backlog_seconds=36000, running_jobs=1), current=1
+    )
+    assert wanted == 3
+
+
+def test_desired_workers_capped_at_maximum(r):
+    wanted = worker_autoscaler.desired_workers(
+        backlog(waiting_jobs=50, backlog_seconds=50 * 3600), current=1
+    )
+    assert wanted == 8
+
+
+def test_desired_workers_async_slots(r, monkeypatch):
+    monkeypatch.setattr(worker_autoscaler, "WORKER_MODE", "async")
+    monkeypatch.setattr(worker_autoscaler, "ASYNC_WORKER_JOBS", 4)
+    wanted = worker_autoscaler.desired_workers(
+        backlog(waiting_jobs=6, backlog_seconds=6 * 3600, running_jobs=5), current=2
+    )
+    assert wanted == 4
+
+
+def test_desired_workers_saturated_does_not_grow(r):
+    wanted = worker_autoscaler.desired_workers(
+        backlog(waiting_jobs=5, backlog_seconds=5 * 3600, running_jobs=2, saturated=["chickadee"]),
+        current=3,
+    )
+    assert wanted == 3
+    # Busy workers are still kept
+    wanted = worker_autoscaler.desired_workers(
+        backlog(waiting_jobs=5, backlog_seconds=5 * 3600, running_jobs=4, saturated=["finch"]),
+        current=1,
+    )
+    assert wanted == 4
+
+
+def test_backlog_from_redis_to_workers(r):
+    for user in ("a@x", "b@x", "c@x"):
+        submit(r, user, 3600)
+    wanted = worker_autoscaler.desired_workers(worker_autoscaler.collect_backlog(r), current=1)
+    assert wanted == 3